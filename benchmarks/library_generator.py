@@ -0,0 +1,186 @@
+#! /usr/bin/env python3
+"""
+Generate a synthetic library to benchmark Plex Librarian against.
+
+Usage:
+    python benchmarks/library_generator.py ROOT [--movies 1000] [--shows 200] [--editions 0] [--seed 0]
+
+The library mixes the folder names found in real libraries, "Title (Year)", "Title (Year) {tmdb-ID}",
+release names and single files, with part of the items already having artwork and trailers and part of
+the movies having a second edition in its own folder. The media
+files are empty. Next to the media, ROOT/library.json describes the sections and items in the format
+expected by benchmarks/stub_server.py, and ROOT/movie_ids.json.gz and ROOT/tv_series_ids.json.gz imitate
+the TMDB daily ID exports, with a few remakes sharing the title of an item.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+
+WORDS = [
+    "Alien", "Apollo", "Arrival", "Autumn", "Black", "Blade", "Blue", "Broken", "City", "Cold", "Crimson",
+    "Dark", "Dawn", "Dead", "Desert", "Distant", "Dream", "Edge", "Empire", "Eternal", "Fall", "Final",
+    "Fire", "Forgotten", "Frozen", "Ghost", "Glass", "Golden", "Green", "Heart", "Heat", "Hidden", "Hollow",
+    "Iron", "Island", "Last", "Light", "Lost", "Midnight", "Moon", "Mountain", "Night", "North", "Ocean",
+    "Paper", "Phantom", "Quiet", "Red", "River", "Road", "Runner", "Salt", "Shadow", "Silent", "Silver",
+    "Sky", "Smoke", "Snow", "Star", "Stone", "Storm", "Summer", "Sun", "Thunder", "Tide", "Time", "Train",
+    "Twilight", "Valley", "Velvet", "War", "Water", "West", "White", "Wild", "Wind", "Winter", "Wolf",
+]
+JOINERS = ["of the", "in the", "and the", "Beyond the", "Under the", "Return of the"]
+RESOLUTIONS = ["720p", "1080p", "2160p"]
+SOURCES = ["BluRay", "WEB-DL", "WEBRip", "HDTV"]
+CODECS = ["x264", "x265", "HEVC"]
+GROUPS = ["SPARKS", "GECKOS", "NTb", "RARBG", "FLUX"]
+MOVIE_ID_START = 1000
+SHOW_ID_START = 500000
+
+
+def generate_library(root, movies=1000, shows=200, artwork=0.5, trailers=0.3, matched=0.8, editions=0.0, seed=0):
+    """
+    Build a synthetic library under the given folder.
+
+    Args:
+        root (str): The folder of the library, created if missing.
+        movies (int): The number of movies.
+        shows (int): The number of TV shows.
+        artwork (float): The share of items that already have a poster, half of them also have a backdrop.
+        trailers (float): The share of items that already have a trailer.
+        matched (float): The share of items Plex has matched to a TMDB ID.
+        editions (float): The share of movies with a second edition, sharing the TMDB ID of the first.
+        seed (int): The seed of the generator, the same seed builds the same library.
+
+    Returns:
+        dict: The sections and items of the library, also written to ROOT/library.json.
+    """
+    rng = random.Random(seed)
+    titles = set()
+    library = {"sections": [], "items": []}
+    for key, media_type, folder, count, id_start in (("1", "movie", "Movies", movies, MOVIE_ID_START),
+                                                     ("2", "show", "TV Shows", shows, SHOW_ID_START)):
+        path = os.path.join(root, folder)
+        os.makedirs(path, exist_ok=True)
+        library["sections"].append({"key": key, "type": media_type, "path": path})
+        for i in range(count):
+            title = _get_title(rng, titles)
+            year = rng.randint(1950, 2024)
+            tmdb_id = id_start + i
+            if media_type == "movie":
+                item = _create_movie(rng, path, title, year, tmdb_id)
+            else:
+                item = _create_show(rng, path, title, year)
+            if os.path.isdir(item):
+                _create_assets(rng, item, artwork, trailers)
+            library["items"].append({
+                "section": key,
+                "type": media_type,
+                "rating_key": str(int(key) * 10000000 + i),
+                "title": title,
+                "year": year,
+                "tmdb_id": tmdb_id,
+                "matched": rng.random() < matched,
+                "path": item
+            })
+            if media_type == "movie" and editions and rng.random() < editions:
+                edition = os.path.join(path, f"{title} ({year}) {{edition-Extended}}")
+                os.makedirs(edition, exist_ok=True)
+                open(os.path.join(edition, f"{title} ({year}) {{edition-Extended}}.mkv"), "w").close()
+                library["items"].append(dict(library["items"][-1], rating_key=str(int(key) * 10000000 + count + i),
+                                             matched=True, path=edition))
+
+    with open(os.path.join(root, "library.json"), "w", encoding="utf-8") as file:
+        json.dump(library, file)
+    _write_exports(rng, root, library)
+    return library
+
+
+def _write_exports(rng, root, library):
+    """Write the items to exports in the format of the TMDB daily ID exports."""
+    for media_type, filename, field in (("movie", "movie_ids.json.gz", "original_title"),
+                                        ("show", "tv_series_ids.json.gz", "original_name")):
+        items = [item for item in library.get("items") if item.get("type") == media_type]
+        next_id = (SHOW_ID_START if media_type == "show" else MOVIE_ID_START) + len(items)
+        with gzip.open(os.path.join(root, filename), "wt", encoding="utf-8") as file:
+            for item in {item.get("tmdb_id"): item for item in items}.values():
+                file.write(json.dumps({"id": item.get("tmdb_id"), field: item.get("title"),
+                                       "popularity": round(rng.uniform(0.5, 50), 3)}) + "\n")
+                if rng.random() < 0.1:
+                    # A remake or another show with the same title
+                    file.write(json.dumps({"id": next_id, field: item.get("title"),
+                                           "popularity": round(rng.uniform(0.5, 50), 3)}) + "\n")
+                    next_id += 1
+
+
+def _get_title(rng, titles):
+    while True:
+        words = rng.sample(WORDS, rng.choice([1, 2, 2, 3]))
+        if len(words) == 3 and rng.random() < 0.5:
+            words.insert(1, rng.choice(JOINERS))
+        title = " ".join(words)
+        if title not in titles:
+            titles.add(title)
+            return title
+
+
+def _create_movie(rng, section, title, year, tmdb_id):
+    """Create a movie with one of the naming styles found in real libraries."""
+    style = rng.random()
+    if style < 0.1:
+        item = os.path.join(section, f"{title} ({year}).mkv")
+        open(item, "w").close()
+        return item
+    if style < 0.55:
+        name = f"{title} ({year})"
+    elif style < 0.7:
+        name = f"{title} ({year}) {{tmdb-{tmdb_id}}}"
+    else:
+        name = (f"{title.replace(' ', '.')}.{year}.{rng.choice(RESOLUTIONS)}.{rng.choice(SOURCES)}."
+                f"{rng.choice(CODECS)}-{rng.choice(GROUPS)}")
+    item = os.path.join(section, name)
+    os.makedirs(item, exist_ok=True)
+    open(os.path.join(item, f"{name}.mkv"), "w").close()
+    return item
+
+
+def _create_show(rng, section, title, year):
+    """Create a TV show with a few seasons of empty episodes."""
+    item = os.path.join(section, f"{title} ({year})")
+    for season in range(1, rng.randint(1, 4) + 1):
+        season_folder = os.path.join(item, f"Season {season:02d}")
+        os.makedirs(season_folder, exist_ok=True)
+        for episode in range(1, rng.randint(3, 10) + 1):
+            open(os.path.join(season_folder, f"{title} - S{season:02d}E{episode:02d}.mkv"), "w").close()
+    return item
+
+
+def _create_assets(rng, item, artwork, trailers):
+    if rng.random() < artwork:
+        # A few posters are empty, as left behind by a failed download
+        with open(os.path.join(item, "poster.jpg"), "wb") as file:
+            file.write(b"" if rng.random() < 0.05 else b"\xff\xd8" + bytes(1024))
+        if rng.random() < 0.5:
+            with open(os.path.join(item, "backdrop.jpg"), "wb") as file:
+                file.write(b"\xff\xd8" + bytes(2048))
+    if rng.random() < trailers:
+        os.makedirs(os.path.join(item, "Trailers"), exist_ok=True)
+        open(os.path.join(item, "Trailers", "Official Trailer.mp4"), "w").close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("root", help="folder of the library")
+    parser.add_argument("--movies", type=int, default=1000, help="number of movies")
+    parser.add_argument("--shows", type=int, default=200, help="number of TV shows")
+    parser.add_argument("--editions", type=float, default=0.0, help="share of movies with a second edition")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generator")
+    args = parser.parse_args()
+
+    library = generate_library(args.root, args.movies, args.shows, editions=args.editions, seed=args.seed)
+    print(f"Generated {len(library['items'])} items in {args.root}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+#! /usr/bin/env python3
+"""
+Check the filename parsers against the corpus of folder names and time them.
+
+Usage:
+    python benchmarks/parse_benchmark.py [--items 100000] [--update]
+
+The corpus at benchmarks/corpus/folder_names.jsonl holds one folder name per line together
+with the result expected from the parser. Any mismatch is printed and the script exits with 1.
+Use --update to rewrite the expected results after an intended change in the parsers.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "plex_librarian"))
+
+from utils.names import parse_movie_name, parse_show_name  # noqa: E402
+from utils.tools import get_movie_title, get_show_title  # noqa: E402
+
+CORPUS = os.path.join(ROOT, "benchmarks", "corpus", "folder_names.jsonl")
+PARSERS = {"movie": get_movie_title, "show": get_show_title}
+
+
+def load_corpus():
+    with open(CORPUS, "r", encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def check(corpus):
+    """
+    Compare the parsers against the expected results.
+
+    Returns:
+        int: The number of mismatches.
+    """
+    mismatches = 0
+    for entry in corpus:
+        result = PARSERS[entry["type"]](entry["name"])
+        if result != entry["expected"]:
+            mismatches += 1
+            print(f"MISMATCH {entry['type']} {entry['name']!r}\n  expected: {entry['expected']}\n  got:      {result}")
+    return mismatches
+
+
+def update(corpus):
+    with open(CORPUS, "w", encoding="utf-8") as file:
+        for entry in corpus:
+            entry["expected"] = PARSERS[entry["type"]](entry["name"])
+            file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    print(f"Updated {len(corpus)} expected results")
+
+
+def benchmark(corpus, items):
+    """
+    Time the parsers over a library of the given size.
+
+    The cold run uses unique names so every call goes through the regex engine,
+    the warm run parses the same names again and is served by the memoization.
+    """
+    names = []
+    for i in range(items):
+        entry = corpus[i % len(corpus)]
+        # Prefix the round so every name is unique for the cold run
+        names.append((entry["type"], f"{i // len(corpus)} {entry['name']}"))
+
+    parse_movie_name.cache_clear()
+    parse_show_name.cache_clear()
+    parsers = {"movie": parse_movie_name, "show": parse_show_name}
+    for label in ("cold", "warm"):
+        start = time.perf_counter()
+        for media_type, name in names:
+            parsers[media_type](name)
+        elapsed = time.perf_counter() - start
+        print(f"{label}: {items} names in {elapsed * 1000:.1f} ms ({elapsed / items * 1e6:.2f} us/name)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=100000, help="number of names to parse in the benchmark")
+    parser.add_argument("--update", action="store_true", help="rewrite the expected results of the corpus")
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    if args.update:
+        update(corpus)
+        return 0
+    mismatches = check(corpus)
+    print(f"{len(corpus) - mismatches}/{len(corpus)} names parsed as expected")
+    benchmark(corpus, args.items)
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+#! /usr/bin/env python3
+"""
+Benchmark Plex Librarian end to end against a synthetic library and a local Plex/TMDB stub.
+
+Usage:
+    python benchmarks/run_benchmarks.py [--movies 2000] [--shows 300] [--latency 0.005] [--rate-limit 0]
+                                        [--workers 8] [--editions 0] [--image-store]
+                                        [--only scan,parse,posters,...] [--output results.json]
+
+Everything runs offline in a temporary folder: the library is built by library_generator.py with a
+fixed seed, Plex and TMDB are served by stub_server.py and the config points every service at the stub.
+The benchmarks run in order, each on the library left by the previous one:
+
+- title-index: build the offline title index from the generated TMDB exports
+- scan: build the library index without a manifest, then with a new and an up to date manifest
+- parse: parse the names of every item, with a cold and a warm parser cache
+- plex-media: list the items of every section, in XML and JSON, in pages and in one request
+- posters, backdrops: download the missing artwork
+- trailers: look up the missing trailers, as a dry run so nothing is downloaded from YouTube
+- posters-refresh: check every poster for changes
+"""
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "plex_librarian"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import plex_librarian  # noqa: E402
+from library_generator import generate_library  # noqa: E402
+from stub_server import StubServer  # noqa: E402
+from utils.library import build_library_index  # noqa: E402
+from utils.manifest import Manifest  # noqa: E402
+from utils.names import parse_movie_name, parse_show_name  # noqa: E402
+from utils.tools import get_movie_title, get_show_title  # noqa: E402
+
+BENCHMARKS = ["title-index", "scan", "parse", "plex-media", "posters", "backdrops", "trailers", "posters-refresh"]
+
+
+def write_config(workdir, url, workers, library_root, image_store=False):
+    """Write a config pointing every service at the stub, JSON being valid YAML."""
+    exports = {"movie": os.path.join(library_root, "movie_ids.json.gz"),
+               "show": os.path.join(library_root, "tv_series_ids.json.gz")}
+    config = {
+        "workers": workers,
+        "plex": {"token": "benchmark", "server_url": url},
+        "tmdb": {"apikey": "benchmark", "api_url": f"{url}/3", "image_url": f"{url}/t/p",
+                 "title_index": {"exports": exports}},
+        "manifest": {"path": "config/manifest.json"},
+        "metrics": {"prometheus": "config/metrics.prom"},
+        # On the filesystem of the library, so the images can be hardlinked
+        "image_store": {"enabled": image_store, "path": os.path.join(library_root, ".images")}
+    }
+    os.makedirs(os.path.join(workdir, "config"), exist_ok=True)
+    with open(os.path.join(workdir, "config", "config.yml"), "w", encoding="utf-8") as file:
+        json.dump(config, file, indent=2)
+
+
+def reset_services():
+    """Drop the services and config loaded by the previous command, like a new run of the tool."""
+    plex_librarian._config = None
+    plex_librarian._plex = None
+    plex_librarian._tmdb = None
+    plex_librarian._manifest = None
+    plex_librarian._manifest_loaded = False
+    plex_librarian._image_store = None
+    plex_librarian._image_store_loaded = False
+
+
+def bench_scan(library, stub, args):
+    sections = [{"type": section.get("type"), "path": [section.get("path")]} for section in library.get("sections")]
+    results = [_time("scan (no manifest)", lambda: build_library_index(sections))]
+    manifest = Manifest(os.path.join("config", "scan-manifest.json"))
+    results.append(_time("scan (new manifest)", lambda: build_library_index(sections, manifest)))
+    results.append(_time("scan (up to date manifest)", lambda: build_library_index(sections, manifest)))
+    return results
+
+
+def bench_parse(library, stub, args):
+    parsers = {"movie": get_movie_title, "show": get_show_title}
+    names = [(item.get("type"), os.path.basename(item.get("path"))) for item in library.get("items")]
+
+    def parse():
+        for media_type, name in names:
+            parsers[media_type](name)
+
+    parse_movie_name.cache_clear()
+    parse_show_name.cache_clear()
+    return [_time(f"parse {len(names)} names (cold)", parse), _time(f"parse {len(names)} names (warm)", parse)]
+
+
+def bench_plex_media(library, stub, args):
+    reset_services()
+    plex = plex_librarian.get_plex()
+    sections = [section.get("key") for section in library.get("sections")]
+    results = []
+    for media_format in ("xml", "json"):
+        for page_size in (500, len(library.get("items"))):
+            plex.format = media_format
+            plex.page_size = page_size
+
+            def list_media():
+                return sum(1 for section in sections for _ in plex.get_media(section))
+
+            # The stub renders every page once, so only the memory used by the client is traced
+            list_media()
+            tracemalloc.start()
+            result = _time(f"plex media ({media_format}, pages of {page_size})", list_media)
+            result["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1e6, 2)
+            tracemalloc.stop()
+            results.append(result)
+    return results
+
+
+def bench_command(name, command, **kwargs):
+    def bench(library, stub, args):
+        reset_services()
+        stub.reset_counters()
+        result = _time(name, lambda: command(workers=args.workers, **kwargs), args.verbose)
+        result["requests"] = dict(sorted(stub.requests.items()))
+        result["bytes"] = stub.bytes
+        # Every command writes its own report, the last one written is the report of this command
+        reports = glob.glob(os.path.join("config", "metrics_*.json"))
+        with open(max(reports, key=os.path.getmtime), "r", encoding="utf-8") as file:
+            exported = json.load(file)
+        result["stages"] = {gauge.get("labels").get("stage"): round(gauge.get("value"), 4)
+                            for gauge in exported.get("gauges") if gauge.get("name") == "stage_duration_seconds"}
+        return [result]
+    return bench
+
+
+RUNNERS = {
+    "title-index": bench_command("title index", plex_librarian.build_title_index),
+    "scan": bench_scan,
+    "parse": bench_parse,
+    "plex-media": bench_plex_media,
+    "posters": bench_command("posters", plex_librarian.get_posters),
+    "backdrops": bench_command("backdrops", plex_librarian.get_backdrops),
+    "trailers": bench_command("trailers (dry run)", plex_librarian.get_trailers, dry_run=True),
+    "posters-refresh": bench_command("posters (refresh)", plex_librarian.get_posters, refresh=True),
+}
+
+
+def _time(name, func, verbose=False):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(sys.stdout if verbose else output):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+    return {"name": name, "seconds": round(elapsed, 4)}
+
+
+def print_results(results):
+    width = max(len(result.get("name")) for result in results)
+    for result in results:
+        line = f"{result.get('name'):<{width}}  {result.get('seconds'):>9.3f} s"
+        if result.get("requests"):
+            line += "  " + ", ".join(f"{endpoint}={count}" for endpoint, count in result.get("requests").items())
+        if result.get("bytes"):
+            line += f", {result.get('bytes') / 1e6:.1f} MB"
+        if result.get("peak_mb") is not None:
+            line += f"  peak memory {result.get('peak_mb'):.2f} MB"
+        print(line)
+        if result.get("stages"):
+            print(" " * (width + 2) + "stages: " + ", ".join(f"{stage} {seconds:.3f} s"
+                                                             for stage, seconds in result.get("stages").items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--movies", type=int, default=2000, help="number of movies in the library")
+    parser.add_argument("--shows", type=int, default=300, help="number of TV shows in the library")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the library generator")
+    parser.add_argument("--latency", type=float, default=0.005, help="delay of every stub response, in seconds")
+    parser.add_argument("--rate-limit", type=int, default=0, help="answer every Nth TMDB API request with a 429")
+    parser.add_argument("--workers", type=int, default=8, help="number of items processed at once")
+    parser.add_argument("--editions", type=float, default=0.0, help="share of movies with a second edition")
+    parser.add_argument("--image-store", action="store_true", help="download the images through the image store")
+    parser.add_argument("--only", help="comma separated benchmarks to run, out of " + ", ".join(BENCHMARKS))
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the commands")
+    args = parser.parse_args()
+
+    selected = args.only.split(",") if args.only else BENCHMARKS
+    unknown = [name for name in selected if name not in RUNNERS]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+    output = os.path.abspath(args.output) if args.output else None
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="plex-librarian-bench-") as workdir:
+        library_root = os.path.join(workdir, "library")
+        library = generate_library(library_root, args.movies, args.shows, editions=args.editions, seed=args.seed)
+        stub = StubServer(library, args.latency, args.rate_limit).start()
+        write_config(workdir, stub.url, args.workers, library_root, args.image_store)
+        # The config and the manifest are loaded from paths relative to the working folder
+        os.chdir(workdir)
+        try:
+            results = []
+            for name in BENCHMARKS:
+                if name in selected:
+                    results.extend(RUNNERS[name](library, stub, args))
+        finally:
+            os.chdir(cwd)
+            stub.stop()
+
+    print(f"{len(library.get('items'))} items, {args.latency * 1000:.1f} ms latency, {args.workers} workers")
+    print_results(results)
+    if output:
+        with open(output, "w", encoding="utf-8") as file:
+            json.dump({"settings": vars(args), "results": results}, file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,339 @@
+#! /usr/bin/env python3
+"""
+Serve a local imitation of the Plex and TMDB APIs for a synthetic library.
+
+Usage:
+    python benchmarks/stub_server.py ROOT/library.json [--port 8765] [--latency 0.01] [--rate-limit 50]
+
+A single server answers for all of them, Plex on /library, the TMDB API on /3 and the TMDB image CDN
+on /t/p, so a config only needs to point plex.server_url, tmdb.api_url and tmdb.image_url at it.
+Every request waits for the configured latency and every Nth TMDB API request is answered with
+a 429, so the retries of the transport are exercised too.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from xml.sax.saxutils import quoteattr
+
+ORIGINAL_WIDTH = 2000
+
+
+class StubServer:
+    """
+    The Plex and TMDB stub of a library.
+
+    ``requests`` counts the requests received per endpoint and ``bytes`` the image bytes sent,
+    so the benchmarks can report them.
+    """
+
+    def __init__(self, library, latency=0.0, rate_limit=0, image_size=262144, port=0):
+        """
+        Args:
+            library (dict): The library as returned by ``generate_library``.
+            latency (float): The delay of every response, in seconds.
+            rate_limit (int): Answer every Nth TMDB API request with a 429, never if 0.
+            image_size (int): The size of an original image in bytes, the other sizes are scaled down.
+            port (int): The port to listen on, any free port if 0.
+        """
+        self.library = library
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.image_size = image_size
+        self.requests = Counter()
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._api_requests = 0
+        self._items = {}
+        self._titles = {}
+        # The rendered pages of section items, so serving them again doesn't allocate
+        self._pages = {}
+        for item in library.get("items"):
+            self._items.setdefault(item.get("section"), []).append(item)
+            self._titles[(item.get("type"), item.get("title").lower())] = item
+        self._tmdb = {(item.get("type"), item.get("tmdb_id")): item for item in library.get("items")}
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), _get_handler(self))
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests.clear()
+            self.bytes = 0
+
+    def _count(self, endpoint, size=0):
+        with self._lock:
+            self.requests[endpoint] += 1
+            self.bytes += size
+
+    def _is_rate_limited(self):
+        if not self.rate_limit:
+            return False
+        with self._lock:
+            self._api_requests += 1
+            return self._api_requests % self.rate_limit == 0
+
+    # PLEX
+
+    def get_sections(self):
+        directories = []
+        for section in self.library.get("sections"):
+            directories.append(f'<Directory key="{section.get("key")}" type="{section.get("type")}">'
+                               f'<Location id="{section.get("key")}" path={quoteattr(section.get("path"))}/>'
+                               f'</Directory>')
+        return self._get_container(directories, len(directories))
+
+    def get_section_items(self, key, start, size):
+        items = self._items.get(key, [])
+        elements = [self._get_element(item) for item in items[start:start + size]]
+        return self._get_container(elements, len(items), start)
+
+    def get_section_page(self, key, start, size, media_format="xml"):
+        """Get the body of a page of section items, rendered once."""
+        page_key = (key, start, size, media_format)
+        with self._lock:
+            body = self._pages.get(page_key)
+        if body is None:
+            if media_format == "json":
+                body = json.dumps(self.get_section_items_json(key, start, size)).encode("utf-8")
+            else:
+                body = self.get_section_items(key, start, size).encode("utf-8")
+            with self._lock:
+                self._pages[page_key] = body
+        return body
+
+    def get_section_items_json(self, key, start, size):
+        items = self._items.get(key, [])
+        metadata = [self._get_metadata(item) for item in items[start:start + size]]
+        return {"MediaContainer": {"size": len(metadata), "totalSize": len(items), "offset": start,
+                                   "Metadata": metadata}}
+
+    @staticmethod
+    def _get_metadata(item):
+        metadata = {"ratingKey": item.get("rating_key"), "title": item.get("title"), "year": item.get("year")}
+        if item.get("matched"):
+            metadata["Guid"] = [{"id": f"tmdb://{item.get('tmdb_id')}"}]
+        if item.get("type") == "show":
+            metadata["Location"] = [{"path": item.get("path")}]
+            return metadata
+        file = item.get("path")
+        if not file.endswith(".mkv"):
+            file = os.path.join(file, "movie.mkv")
+        metadata["Media"] = [{"Part": [{"file": file}]}]
+        return metadata
+
+    @staticmethod
+    def _get_element(item):
+        guids = f'<Guid id="tmdb://{item.get("tmdb_id")}"/>' if item.get("matched") else ""
+        attributes = (f'ratingKey="{item.get("rating_key")}" title={quoteattr(item.get("title"))} '
+                      f'year="{item.get("year")}"')
+        if item.get("type") == "show":
+            return f'<Directory {attributes}>{guids}<Location path={quoteattr(item.get("path"))}/></Directory>'
+        file = item.get("path")
+        if not file.endswith(".mkv"):
+            file = os.path.join(file, "movie.mkv")
+        return f'<Video {attributes}>{guids}<Media><Part file={quoteattr(file)}/></Media></Video>'
+
+    @staticmethod
+    def _get_container(elements, total, start=0):
+        return (f'<?xml version="1.0" encoding="UTF-8"?><MediaContainer size="{len(elements)}" '
+                f'totalSize="{total}" offset="{start}">{"".join(elements)}</MediaContainer>')
+
+    # TMDB
+
+    def search(self, media_type, query):
+        item = self._titles.get((media_type, (query or "").lower()))
+        if item is None:
+            return {"page": 1, "results": [], "total_results": 0}
+        return {"page": 1, "results": [self._get_summary(item)], "total_results": 1}
+
+    def get_details(self, media_type, tmdb_id, append):
+        item = self._tmdb.get((media_type, tmdb_id))
+        if item is None:
+            return None
+        details = self._get_summary(item)
+        if "images" in append:
+            details["images"] = self.get_images(item)
+        if "videos" in append:
+            details["videos"] = self.get_videos(item)
+        prefix = f"/{item.get('type')}{item.get('tmdb_id')}"
+        for entry in append:
+            if entry.startswith("season/") and entry.endswith("/images"):
+                season = entry.split("/")[1]
+                details[entry] = {"posters": [
+                    {"file_path": f"{prefix}s{season}.jpg", "iso_639_1": "en", "width": ORIGINAL_WIDTH, "height": 3000}
+                ]}
+        return details
+
+    @staticmethod
+    def _get_summary(item):
+        if item.get("type") == "movie":
+            return {"id": item.get("tmdb_id"), "title": item.get("title"), "release_date": f"{item.get('year')}-01-01"}
+        return {"id": item.get("tmdb_id"), "name": item.get("title"), "first_air_date": f"{item.get('year')}-01-01"}
+
+    @staticmethod
+    def get_images(item):
+        prefix = f"/{item.get('type')}{item.get('tmdb_id')}"
+        return {
+            "id": item.get("tmdb_id"),
+            "posters": [
+                {"file_path": f"{prefix}p.jpg", "iso_639_1": "en", "width": ORIGINAL_WIDTH, "height": 3000},
+                {"file_path": f"{prefix}pf.jpg", "iso_639_1": "fr", "width": ORIGINAL_WIDTH, "height": 3000}
+            ],
+            "backdrops": [
+                {"file_path": f"{prefix}b.jpg", "iso_639_1": None, "width": 3840, "height": 2160}
+            ]
+        }
+
+    @staticmethod
+    def get_videos(item):
+        return {"id": item.get("tmdb_id"), "results": [
+            {"type": "Teaser", "key": f"teaser{item.get('tmdb_id')}", "name": "Teaser", "size": 1080},
+            {"type": "Trailer", "key": f"trailer{item.get('tmdb_id')}", "name": "Official Trailer", "size": 1080}
+        ]}
+
+    def get_image(self, size, file_path):
+        """Get the bytes of an image, smaller for the smaller sizes like on the real CDN."""
+        if size == "original":
+            length = self.image_size
+        else:
+            length = self.image_size * min(int(size[1:]), ORIGINAL_WIDTH) // ORIGINAL_WIDTH
+        seed = hashlib.sha1(file_path.encode()).digest()
+        return (seed * (length // len(seed) + 1))[:length]
+
+
+def _get_handler(stub):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if stub.latency:
+                time.sleep(stub.latency)
+            parts = urlsplit(self.path)
+            query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+            path = parts.path
+            if path == "/library/sections":
+                stub._count("plex sections")
+                return self._send_xml(stub.get_sections())
+            match = re.fullmatch(r"/library/sections/(\w+)/all", path)
+            if match:
+                stub._count("plex items")
+                start = int(self.headers.get("X-Plex-Container-Start", 0))
+                size = int(self.headers.get("X-Plex-Container-Size", 1000000))
+                if self.headers.get("Accept") == "application/json":
+                    return self._send(200, stub.get_section_page(match.group(1), start, size, "json"),
+                                      {"Content-Type": "application/json"})
+                return self._send(200, stub.get_section_page(match.group(1), start, size),
+                                  {"Content-Type": "application/xml"})
+            if re.fullmatch(r"/library/sections/\w+/refresh", path):
+                stub._count("plex scan")
+                return self._send(200, b"")
+            if path.startswith("/t/p/"):
+                return self._send_image(path)
+            if path.startswith("/3/"):
+                return self._send_api(path, query)
+            self._send(404, b"")
+
+        def do_PUT(self):
+            if stub.latency:
+                time.sleep(stub.latency)
+            stub._count("plex refresh")
+            self._send(200, b"")
+
+        def _send_api(self, path, query):
+            if stub._is_rate_limited():
+                stub._count("tmdb 429")
+                return self._send(429, b"", {"Retry-After": "0"})
+            match = re.fullmatch(r"/3/search/(movie|tv)", path)
+            if match:
+                stub._count("tmdb search")
+                media_type = "movie" if match.group(1) == "movie" else "show"
+                return self._send_json(stub.search(media_type, query.get("query")))
+            match = re.fullmatch(r"/3/(movie|tv)/(\d+)(/images|/videos)?", path)
+            if match:
+                media_type = "movie" if match.group(1) == "movie" else "show"
+                if match.group(3):
+                    stub._count(f"tmdb {match.group(3)[1:]}")
+                    append = [match.group(3)[1:]]
+                else:
+                    stub._count("tmdb details")
+                    append = query.get("append_to_response", "").split(",")
+                details = stub.get_details(media_type, int(match.group(2)), append)
+                if details is None:
+                    return self._send_json({"success": False, "status_code": 34}, 404)
+                if match.group(3):
+                    details = details.get(match.group(3)[1:])
+                return self._send_json(details)
+            self._send_json({"success": False}, 404)
+
+        def _send_image(self, path):
+            match = re.fullmatch(r"/t/p/(\w+)(/.+)", path)
+            if match is None:
+                return self._send(404, b"")
+            etag = f'"{match.group(1)}{match.group(2)}"'
+            if self.headers.get("If-None-Match") == etag:
+                stub._count("cdn 304")
+                return self._send(304, b"", {"ETag": etag})
+            body = stub.get_image(match.group(1), match.group(2))
+            stub._count("cdn image", len(body))
+            self._send(200, body, {"Content-Type": "image/jpeg", "ETag": etag})
+
+        def _send_xml(self, body):
+            self._send(200, body.encode("utf-8"), {"Content-Type": "application/xml"})
+
+        def _send_json(self, body, status=200):
+            self._send(status, json.dumps(body).encode("utf-8"), {"Content-Type": "application/json"})
+
+        def _send(self, status, body, headers=None):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if status != 304:
+                self.wfile.write(body)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("library", help="library.json written by library_generator.py")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on")
+    parser.add_argument("--latency", type=float, default=0.0, help="delay of every response, in seconds")
+    parser.add_argument("--rate-limit", type=int, default=0, help="answer every Nth TMDB API request with a 429")
+    args = parser.parse_args()
+
+    with open(args.library, "r", encoding="utf-8") as file:
+        library = json.load(file)
+    stub = StubServer(library, args.latency, args.rate_limit, port=args.port).start()
+    print(f"Serving Plex and TMDB on {stub.url}, press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stub.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -15,4 +15,4 @@ if __name__ == "__main__":
         print("Plex Media Manager requires Python 3.6+\nYou are using Python %s, which is not supported by Plex Media Manager" % python_version)
         sys.exit(1)
 
-    plex_librarian.main()
+    plex_librarian.main(sys.argv[1:])
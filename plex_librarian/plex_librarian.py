@@ -1,231 +1,795 @@
 #! /usr/bin/env python3
 """
 This module contains the main logic to download and organize any Plex Media Library.
+
+The services and the heavier modules are loaded on first use, so commands that don't need
+them, e.g. ``--help``, start instantly.
 """
 
+import argparse
 import sys
-from prettytable import PrettyTable
-from progress.bar import ShadyBar
-from services.plex import Plex
-from services.tmdb import TMDB
-from utils import artwork
+from urllib.parse import urlsplit
+from utils import artwork, metrics
+from utils.library import build_library_index, get_season_poster_name, DEFAULT_SCAN_WORKERS
 from utils.tools import *
-from config import load_config
+from utils.workers import run_concurrently, DEFAULT_WORKERS
 
+VERSION = "0.1"
 
-config_file = load_config()
-if config_file is None:
-    sys.exit(1)
-plex = Plex(config_file)
-tmdb = TMDB(config_file)
+_config = None
+_plex = None
+_tmdb = None
+_manifest = None
+_manifest_loaded = False
+_image_store = None
+_image_store_loaded = False
+_trailer_pipeline = None
+# Items changed by the running command, Plex is notified about them at the end
+_changed = []
 
 
-def get_posters():
+def get_config():
     """
-    Download all the posters
+    Load the config on first use.
+
+    Returns:
+        dict: The loaded config.yml, exits if it can't be loaded.
     """
-    sections = plex.get_sections()
-    media = get_media(sections)
-    missing_poster = {}
-    for entry in media:
-        section_media = media.get(entry)
-        missing_in_section = []
-        for item in section_media:
-            if not has_poster(item):
-                missing_in_section.append(item)
-        missing_poster[entry] = missing_in_section
+    global _config
+    if _config is None:
+        from config import load_config
+        from utils import transport
+        config_file = load_config()
+        if config_file is None:
+            sys.exit(1)
+        transport.configure(config_file)
+        _config = config_file
+    return _config
+
+
+def get_plex():
+    """Build the Plex service on first use."""
+    global _plex
+    if _plex is None:
+        from services.plex import Plex
+        _plex = Plex(get_config())
+    return _plex
+
+
+def get_tmdb():
+    """Build the TMDB service on first use."""
+    global _tmdb
+    if _tmdb is None:
+        from services.tmdb import TMDB
+        _tmdb = TMDB(get_config())
+    return _tmdb
+
+
+def get_manifest():
+    """Load the manifest on first use, None if it's disabled."""
+    global _manifest, _manifest_loaded
+    if not _manifest_loaded:
+        from utils.manifest import Manifest
+        _manifest = Manifest.from_config(get_config())
+        _manifest_loaded = True
+    return _manifest
+
+
+def get_image_store():
+    """Open the image store on first use, None if it's disabled."""
+    global _image_store, _image_store_loaded
+    if not _image_store_loaded:
+        from utils.image_store import ImageStore
+        _image_store = ImageStore.from_config(get_config())
+        _image_store_loaded = True
+    return _image_store
+
+
+def get_posters(section_types=None, workers=None, dry_run=False, refresh=False):
+    """
+    Download all the posters, including the posters of the seasons of the TV shows.
 
-    table = PrettyTable()
-    table.title = "Failed Downloads"
-    table.field_names = ["Title", "Release Year", "TMDB ID", "Type"]
-    for entry in missing_poster:
-        # GET THE MEDIA IN CURRENT WORKING SECTION
-        section_media = missing_poster.get(entry)
-        # IF LIST IS EMPTY(NO MISSING POSTER)
-        if not section_media:
+    Args:
+        refresh (bool): Also check the posters downloaded by Plex Librarian and download the ones that changed on TMDB.
+    """
+    index = _build_index(section_types)
+    missing_poster = _get_missing(index.media, lambda item: item.has_poster
+                                  and not (refresh and _get_download(item.path, "poster")))
+    missing_season = _get_missing_seasons(index, refresh)
+    # THE SHOWS MISSING ONLY SEASON POSTERS NEED THEIR TMDB ID TOO
+    missing_shows = list(dict.fromkeys((missing_poster.get("show") or []) + list(missing_season)))
+    _load_plex_media(index.sections, dict(missing_poster, show=missing_shows))
+    try:
+        with metrics.stage("downloads"):
+            _run_downloads(missing_poster, _download_poster, workers, dry_run)
+        if missing_season:
+            _get_season_posters(missing_season, workers, dry_run)
+        _notify_plex(index.sections)
+    finally:
+        _report_image_store()
+        # Keeps the validators of interrupted downloads, so they can be resumed
+        _save_manifest()
+        _export_metrics("posters")
+
+
+def get_backdrops(section_types=None, workers=None, dry_run=False, refresh=False):
+    """
+    Download all the backdrops.
+
+    Args:
+        refresh (bool): Also check the backdrops downloaded by Plex Librarian and download the ones that changed
+            on TMDB.
+    """
+    index = _build_index(section_types)
+    missing_backdrop = _get_missing(index.media, lambda item: item.has_backdrop
+                                    and not (refresh and _get_download(item.path, "backdrop")))
+    _load_plex_media(index.sections, missing_backdrop)
+    try:
+        with metrics.stage("downloads"):
+            _run_downloads(missing_backdrop, _download_backdrop, workers, dry_run)
+        _notify_plex(index.sections)
+    finally:
+        _report_image_store()
+        _save_manifest()
+        _export_metrics("backdrops")
+
+
+def get_trailers(section_types=None, workers=None, dry_run=False):
+    """
+    Download the trailers for all media types, movies and TV shows, if they are missing
+    """
+    global _trailer_pipeline
+    index = _build_index(section_types)
+    missing_trailer = _get_missing(index.media, lambda item: item.has_trailer)
+    _load_plex_media(index.sections, missing_trailer)
+    if not dry_run:
+        from utils.trailers import TrailerPipeline
+        _trailer_pipeline = TrailerPipeline.from_config(get_config())
+    try:
+        with metrics.stage("downloads"):
+            _run_downloads(missing_trailer, _download_trailer, workers, dry_run)
+    finally:
+        if _trailer_pipeline is not None:
+            _trailer_pipeline.close()
+            _trailer_pipeline = None
+    _notify_plex(index.sections)
+    _save_manifest()
+    _export_metrics("trailers")
+
+
+@metrics.stage("scan")
+def _build_index(section_types=None):
+    """
+    Build the library index of the Plex sections.
+
+    Args:
+        section_types (list): The section types to include (movie, show), all of them if None.
+
+    Returns:
+        LibraryIndex: The index of the sections.
+    """
+    sections = get_plex().get_sections()
+    if section_types:
+        sections = [section for section in sections if section.get("type") in section_types]
+    scan_config = get_config().get("scan") or {}
+    index = build_library_index(sections, get_manifest(), scan_config.get("workers") or DEFAULT_SCAN_WORKERS,
+                                scan_config.get("roots"))
+    for path, elapsed in index.scan_times.items():
+        print(f"Scanned {path} in {elapsed:.2f} s")
+    return index
+
+
+@metrics.stage("plex_media")
+def _load_plex_media(sections, missing):
+    """
+    Complete the items missing assets with their Plex items, so their TMDB IDs don't need a search.
+
+    Args:
+        sections (list): The sections as returned by ``Plex.get_sections``.
+        missing (dict): The items missing an asset, per section type.
+    """
+    if get_config().get("plex").get("use_guids") is False:
+        return
+    for section in sections:
+        items = {os.path.normpath(item.path): item for item in missing.get(section.get("type")) or []}
+        if not items:
             continue
+        for section_id in section.get("ids", []):
+            for plex_item in get_plex().get_media(section_id):
+                for path in (plex_item.get("path"), plex_item.get("file")):
+                    item = items.get(os.path.normpath(path)) if path else None
+                    if item is not None:
+                        item.set_plex_item(plex_item)
+                        break
 
-        print(f"Starting download for '{entry}'")
-        # START PROGRESS BAR
-        with ShadyBar('Downloading', fill='#', suffix='%(percent).1f%% - %(eta)ds', max=len(missing_poster.get(entry))) as bar:
-            for item in section_media:
-                filename = os.path.basename(item)
-                if entry == "movie":
-                    info = get_movie_title(filename)
-                elif entry == "show":
-                    info = get_show_title(filename)
-                else:
-                    continue
-                title = info.get("title")
-                year = info.get("year")
-                tmdb_id = info.get("tmdb_id")
-
-                # IF TMDB_ID IS MISSING -> SEARCH TMDB
-                if tmdb_id is None:
-                    tmdb_id = tmdb.search(title, year, media_type=entry)
-
-                image = tmdb.get_poster(tmdb_id, media_type=entry)
-                if image is None:
-                    table.add_row([title, year, tmdb_id, entry])
-                    bar.next()
-                    continue
-                image_url = f"https://image.tmdb.org/t/p/original{image}"
-                image_ext = os.path.splitext(image)[1]
-                poster_path = os.path.join(item, f"poster{image_ext}")
-                download_image(image_url, poster_path)
-                bar.next()
-    if not is_table_empty(table):
-        print(table)
+
+@metrics.stage("notify")
+def _notify_plex(sections):
+    """
+    Send partial scans and metadata refreshes to Plex for the items changed by the command.
+
+    Args:
+        sections (list): The sections as returned by ``Plex.get_sections``.
+    """
+    global _changed
+    changed, _changed = _changed, []
+    if not changed or get_config().get("plex").get("notify") is False:
         return
+    section_ids = {}
+    for section in sections:
+        section_ids.update(section.get("section_ids", {}))
+    changes = []
+    for item in changed:
+        section_id = section_ids.get(os.path.dirname(item.path))
+        if section_id is None:
+            continue
+        changes.append((section_id, item.path, item.rating_key))
+    get_plex().notify_changes(changes)
 
 
-def get_backdrops():
+def _get_missing(media, has_asset):
     """
-    Download all the backdrops.
+    Get the items of each section that are missing an asset.
+
+    Args:
+        media (dict): The items of each section type.
+        has_asset (callable): Checks if a ``MediaItem`` already has the asset.
+
+    Returns:
+        dict: The items missing the asset, per section type.
     """
-    sections = plex.get_sections()
-    media = get_media(sections)
-    missing_poster = {}
+    missing = {}
     for entry in media:
-        section_media = media.get(entry)
-        missing_in_section = []
-        for item in section_media:
-            if not has_backdrop(item):
-                missing_in_section.append(item)
-        missing_poster[entry] = missing_in_section
+        missing[entry] = [item for item in media.get(entry) if not has_asset(item)]
+    return missing
+
+
+def _get_download(path, name):
+    """
+    Get the validators of the completed download of an image of an item.
+
+    Args:
+        path (str): The path of the item.
+        name (str): The name of the image, e.g. poster.
+
+    Returns:
+        dict: The validators, None if Plex Librarian didn't download the image.
+    """
+    manifest = get_manifest()
+    record = manifest.get(path) if manifest is not None else None
+    validators = ((record or {}).get("artwork") or {}).get(name) or {}
+    return validators if validators.get("complete") and validators.get("url") else None
+
+
+def _get_previous_image(path, name, image_path):
+    """
+    Get the image Plex Librarian downloaded before in place of a new image, so it can be refreshed.
+
+    TMDB never changes the image of a file path, so a new top image has a new file path, maybe with
+    another extension than the image downloaded before.
+
+    Args:
+        path (str): The path of the item.
+        name (str): The name of the image, e.g. poster.
+        image_path (str): The path of the new image.
+
+    Returns:
+        str: The path of the image downloaded before, None if the existing image wasn't downloaded by
+            Plex Librarian or the new image would replace another one.
+    """
+    validators = _get_download(path, name)
+    if validators is None:
+        return None
+    previous_ext = os.path.splitext(urlsplit(validators.get("url")).path)[1]
+    previous_path = os.path.splitext(image_path)[0] + previous_ext
+    if not os.path.exists(previous_path):
+        return None
+    if previous_path != image_path and os.path.lexists(image_path):
+        return None
+    return previous_path
+
+
+def _remove_previous_image(previous_path, image_path):
+    """Delete the image downloaded before once the new one with another extension is saved."""
+    if previous_path is not None and previous_path != image_path:
+        try:
+            os.remove(previous_path)
+        except OSError as e:
+            print(e)
+
+
+def _get_missing_seasons(index, refresh=False):
+    """
+    Get the season folders of the TV shows that are missing a season poster.
+
+    Args:
+        index (LibraryIndex): The library index.
+        refresh (bool): Include the season folders whose poster was downloaded by Plex Librarian.
 
+    Returns:
+        dict: The season number and folder of the seasons missing a poster, per TV show.
+    """
+    if (get_config().get("posters") or {}).get("seasons") is False:
+        return {}
+    missing = {}
+    for show in index.media.get("show") or []:
+        seasons = [(season, os.path.join(show.path, name)) for season, name, has_poster in show.seasons
+                   if not has_poster or (refresh and _get_download(show.path, get_season_poster_name(season)))]
+        if seasons:
+            missing[show] = seasons
+    return missing
+
+
+def _get_season_posters(missing, workers=None, dry_run=False):
+    """
+    Download the season posters of the TV shows.
+
+    The posters of every season of a show are looked up with one batched TMDB request per show,
+    then the downloads of all the shows fan out into their season folders at once.
+
+    Args:
+        missing (dict): The season number and folder of the seasons missing a poster, per TV show.
+        workers (int): The number of shows and downloads processed at once, the "workers" of the config if None.
+        dry_run (bool): Only look up the posters and print the planned downloads.
+    """
+    get_tmdb()
+    workers = workers or get_config().get("workers") or DEFAULT_WORKERS
+    # SEASON FOLDER -> (SHOW, SEASON NUMBER, POSTER)
+    season_posters = {}
+    failed = 0
+    with metrics.stage("season_lookups"):
+        for show, posters in run_concurrently(lambda _show: _find_season_posters(_show, missing.get(_show)),
+                                              missing, workers):
+            if posters is None:
+                failed += 1
+                continue
+            for season, folder in missing.get(show):
+                if season in posters:
+                    season_posters[folder] = (show, season, posters.get(season))
+    if failed:
+        print(f"Couldn't find the season posters of {failed} TV shows")
+    with metrics.stage("season_downloads"):
+        _run_downloads({"show": list(season_posters)},
+                       lambda folder, entry, planned: _download_season_poster(folder, *season_posters.get(folder),
+                                                                               planned),
+                       workers, dry_run)
+
+
+def _find_season_posters(show, seasons):
+    """
+    Look up the posters of the seasons of a TV show.
+
+    Returns:
+        dict: The poster of each season found, by season number, None if the show couldn't be resolved.
+    """
+    try:
+        resolved = _resolve(show)
+        if resolved is None or resolved[2] is None:
+            return None
+        return get_tmdb().get_season_posters(resolved[2], [season for season, _ in seasons])
+    except Exception as e:
+        print(e)
+        return None
+
+
+def _download_season_poster(folder, show, season, image, planned=None):
+    """
+    Download the poster of a season into its folder.
+
+    Returns:
+        list: The table row of the season if the download failed, None otherwise.
+    """
+    name = get_season_poster_name(season)
+    image_url = get_tmdb().get_image_url(image, "poster")
+    image_path = os.path.join(folder, f"{name}{os.path.splitext(image.get('file_path'))[1]}")
+    has_poster = any(number == season and has_poster for number, _, has_poster in show.seasons)
+    # REFRESH ONLY REVISITS THE POSTERS DOWNLOADED BY PLEX LIBRARIAN
+    previous_path = _get_previous_image(show.path, name, image_path) if has_poster else None
+    if has_poster and previous_path is None:
+        return None
+    if planned is not None:
+        planned.append([image_url, image_path])
+        return None
+    try:
+        manifest = get_manifest()
+        validators = manifest.get_validators(show.path, name) if manifest is not None else None
+        status = _save_image(image_url, image_path, validators)
+    except Exception as e:
+        print(e)
+        status = None
+    if status is None:
+        return [f"{show.name} - {os.path.basename(folder)}", None, None, "show"]
+    if status == "downloaded":
+        _remove_previous_image(previous_path, image_path)
+        _changed.append(show)
+    return None
+
+
+def _run_downloads(missing, download, workers=None, dry_run=False):
+    """
+    Run a download function concurrently over the missing items of every section.
+
+    Args:
+        missing (dict): The items missing an asset, per section type.
+        download (callable): Downloads the asset of one item, returns the table row if it failed.
+        workers (int): The number of items processed at once, the "workers" of the config if None.
+        dry_run (bool): Only look up the assets and print the planned downloads.
+    """
+    from prettytable import PrettyTable
+    from progress.bar import ShadyBar
+
+    # Build the services before fanning out, so the workers share them
+    get_tmdb()
+    workers = workers or get_config().get("workers") or DEFAULT_WORKERS
+    planned = [] if dry_run else None
     table = PrettyTable()
     table.title = "Failed Downloads"
     table.field_names = ["Title", "Release Year", "TMDB ID", "Type"]
-    for entry in missing_poster:
+    for entry in missing:
         # GET THE MEDIA IN CURRENT WORKING SECTION
-        section_media = missing_poster.get(entry)
-        # IF LIST IS EMPTY(NO MISSING POSTER)
+        section_media = missing.get(entry)
+        # IF LIST IS EMPTY(NO MISSING ASSET)
         if not section_media:
             continue
 
         print(f"Starting download for '{entry}'")
         # START PROGRESS BAR
-        with ShadyBar('Downloading', fill='#', suffix='%(percent).1f%% - %(eta)ds', max=len(missing_poster.get(entry))) as bar:
-            for item in section_media:
-                filename = os.path.basename(item)
-                if entry == "movie":
-                    info = get_movie_title(filename)
-                elif entry == "show":
-                    info = get_show_title(filename)
-                else:
-                    continue
-                title = info.get("title")
-                year = info.get("year")
-                tmdb_id = info.get("tmdb_id")
-
-                # IF TMDB_ID IS MISSING -> SEARCH TMDB
-                if tmdb_id is None:
-                    tmdb_id = tmdb.search(title, year, media_type=entry)
-
-                image = tmdb.get_backdrop(tmdb_id, media_type=entry)
-                if image is None:
-                    table.add_row([title, year, tmdb_id, entry])
-                    bar.next()
-                    continue
-                image_url = f"https://image.tmdb.org/t/p/original{image}"
-                image_ext = os.path.splitext(image)[1]
-                backdrop_path = os.path.join(item, f"backdrop{image_ext}")
-                download_image(image_url, backdrop_path)
+        with ShadyBar('Downloading', fill='#', suffix='%(percent).1f%% - %(eta)ds', max=len(section_media)) as bar:
+            for item, failed in run_concurrently(lambda _item: download(_item, entry, planned), section_media, workers):
+                if failed:
+                    table.add_row(failed)
+                metrics.increment("items_total", section=entry, result="failed" if failed else "ok")
                 bar.next()
+    if planned:
+        planned_table = PrettyTable()
+        planned_table.title = "Planned Downloads"
+        planned_table.field_names = ["Source", "Destination"]
+        planned_table.add_rows(planned)
+        print(planned_table)
     if not is_table_empty(table):
         print(table)
         return
 
 
-def get_trailers():
+def _resolve(item):
     """
-    Download the trailers for all media types, movies and TV shows, if they are missing
+    Get the title, release year and TMDB ID of an item, searching TMDB if the ID is missing.
+
+    The name of the item and the Plex item take precedence, and the TMDB ID is kept on the item,
+    so the following lookups of the run don't search again.
+
+    Args:
+        item (MediaItem): The item.
+
+    Returns:
+        tuple: The title, release year and TMDB ID, None if the section type is not supported.
     """
-    sections = plex.get_sections()
-    media = get_media(sections)
-    missing_trailer = {}
-    for entry in media:
-        section_media = media.get(entry)
-        missing_in_section = []
-        for item in section_media:
-            _has_trailer = has_trailer(item)
-            if not _has_trailer:
-                missing_in_section.append(item)
-        missing_trailer[entry] = missing_in_section
+    if item.section not in ("movie", "show"):
+        return None
+    item.parse()
+    if item.title is None:
+        return item.name, None, None
 
-    table = PrettyTable()
-    table.title = "Failed Downloads"
-    table.field_names = ["Title", "Release Year", "TMDB ID", "Type"]
-    for entry in missing_trailer:
-        # GET THE MEDIA IN CURRENT WORKING SECTION
-        section_media = missing_trailer.get(entry)
-        # IF LIST IS EMPTY(NO MISSING POSTER)
-        if not section_media:
-            continue
+    # IF TMDB_ID IS MISSING -> USE THE ONE RESOLVED IN A PREVIOUS RUN OR SEARCH TMDB
+    if item.tmdb_id is None:
+        manifest = get_manifest()
+        if manifest is not None:
+            item.tmdb_id = manifest.get_tmdb_id(item.path)
+        if item.tmdb_id is None:
+            item.tmdb_id = get_tmdb().search(item.title, item.year, media_type=item.section)
+            if item.tmdb_id is not None and manifest is not None:
+                manifest.set_tmdb_id(item.path, item.tmdb_id)
+    return item.title, item.year, item.tmdb_id
 
-        print(f"Starting download for '{entry}'")
-        # START PROGRESS BAR
-        with ShadyBar('Downloading', fill='#', suffix='%(percent).1f%% - %(eta)ds', max=len(missing_trailer.get(entry))) as bar:
-            for item in section_media:
-                filename = os.path.basename(item)
-                if entry == "movie":
-                    info = get_movie_title(filename)
-                elif entry == "show":
-                    info = get_show_title(filename)
-                else:
-                    continue
-                title = info.get("title")
-                year = info.get("year")
-                tmdb_id = info.get("tmdb_id")
-
-                # IF TMDB_ID IS MISSING -> SEARCH TMDB
-                if tmdb_id is None:
-                    tmdb_id = tmdb.search(title, year, media_type=entry)
-
-                video_key = tmdb.get_trailer(tmdb_id, media_type=entry)
-                if video_key is None:
-                    table.add_row([title, year, tmdb_id, entry])
-                    bar.next()
-                    continue
-                video_url = f"https://www.youtube.com/watch?v={video_key}"
-                video_path = os.path.join(item, "Trailers")
-                download_youtube_video(video_url, video_path)
+
+def _save_image(image_url, image_path, validators=None):
+    """Save an image through the image store if it's enabled, see ``download_image``."""
+    store = get_image_store()
+    if store is None:
+        return download_image(image_url, image_path, validators)
+    return store.fetch(image_url, image_path, validators)
+
+
+def _report_image_store():
+    store = get_image_store()
+    if store is not None and store.links:
+        print(f"Linked {store.links} images from the image store, saving {store.bytes_saved / 1e6:.1f} MB of downloads")
+        store.links = store.bytes_saved = 0
+
+
+def _save_manifest():
+    manifest = get_manifest()
+    if manifest is not None:
+        manifest.save()
+
+
+def _export_metrics(command):
+    """Print the stage timings of a command and export its metrics, starting afresh for the next one."""
+    stages = metrics.summary()
+    if stages:
+        print(stages)
+    metrics.export(get_config(), command)
+    metrics.reset()
+
+
+def _download_poster(item, entry, planned=None):
+    return _download_artwork(item, entry, get_tmdb().get_poster, "poster", planned)
+
+
+def _download_backdrop(item, entry, planned=None):
+    return _download_artwork(item, entry, get_tmdb().get_backdrop, "backdrop", planned)
+
+
+def _download_artwork(item, entry, get_image, name, planned=None):
+    """
+    Download an image of an item.
+
+    Args:
+        item (MediaItem): The item.
+        entry (str): The section type of the item.
+        get_image (callable): Gets the image from TMDB.
+        name (str): The filename of the image, without the extension.
+        planned (list): Collects the source and destination instead of downloading, for dry runs.
+
+    Returns:
+        list: The table row of the item if the download failed, None otherwise.
+    """
+    # SINGLE FILE ITEMS HAVE NO FOLDER TO DOWNLOAD INTO
+    if not item.is_dir:
+        return [item.name, None, None, entry]
+    try:
+        resolved = _resolve(item)
+        if resolved is None:
+            return None
+        title, year, tmdb_id = resolved
+        if tmdb_id is None:
+            return [title, year, tmdb_id, entry]
+        image = get_image(tmdb_id, media_type=entry)
+        if image is None:
+            return [title, year, tmdb_id, entry]
+        image_url = get_tmdb().get_image_url(image, name)
+        image_ext = os.path.splitext(image.get("file_path"))[1]
+        image_path = os.path.join(item.path, f"{name}{image_ext}")
+        # REFRESH ONLY REVISITS THE IMAGES DOWNLOADED BY PLEX LIBRARIAN
+        has_image = getattr(item, f"has_{name}")
+        previous_path = _get_previous_image(item.path, name, image_path) if has_image else None
+        if has_image and previous_path is None:
+            return None
+        if planned is not None:
+            planned.append([image_url, image_path])
+            return None
+        manifest = get_manifest()
+        validators = manifest.get_validators(item.path, name) if manifest is not None else None
+        status = _save_image(image_url, image_path, validators)
+        if status is None:
+            return [title, year, tmdb_id, entry]
+        if status == "downloaded":
+            _remove_previous_image(previous_path, image_path)
+            _changed.append(item)
+    except Exception as e:
+        print(e)
+        return [item.name, None, None, entry]
+    return None
+
+
+def _download_trailer(item, entry, planned=None):
+    """
+    Download the trailer of an item.
+
+    Returns:
+        list: The table row of the item if the download failed, None otherwise.
+    """
+    # SINGLE FILE ITEMS HAVE NO FOLDER TO DOWNLOAD INTO
+    if not item.is_dir:
+        return [item.name, None, None, entry]
+    try:
+        resolved = _resolve(item)
+        if resolved is None:
+            return None
+        title, year, tmdb_id = resolved
+        if tmdb_id is None:
+            return [title, year, tmdb_id, entry]
+        video_key = get_tmdb().get_trailer(tmdb_id, media_type=entry)
+        if video_key is None:
+            return [title, year, tmdb_id, entry]
+        video_url = f"https://www.youtube.com/watch?v={video_key}"
+        video_path = os.path.join(item.path, "Trailers")
+        if planned is not None:
+            planned.append([video_url, video_path])
+            return None
+        if not _trailer_pipeline.download(video_url, video_path):
+            return [title, year, tmdb_id, entry]
+        _changed.append(item)
+    except Exception as e:
+        print(e)
+        return [item.name, None, None, entry]
+    return None
+
+
+def rename_media(section_types=None, workers=None, dry_run=False, rollback=False):
+    """
+    Rename all media to ``Title (Year) {tmdb-ID}``.
+
+    The renames are planned from the library index, recorded in the rename journal and applied in
+    parallel batches. If the last run was interrupted, its renames are resumed from the journal
+    without scanning the library again.
+
+    Args:
+        rollback (bool): Undo the renames of the last run instead.
+    """
+    from prettytable import PrettyTable
+    from utils.renamer import RenameJournal, apply_renames, rollback_renames
+
+    journal = RenameJournal.from_config(get_config())
+    workers = workers or get_config().get("workers") or DEFAULT_WORKERS
+    renames = journal.load()
+    pending = [rename for rename in renames if rename.get("state") == "pending"]
+    sections = None
+    if rollback:
+        pending = [rename for rename in reversed(renames) if rename.get("state") == "done"]
+        planned = [(rename.get("target"), rename.get("source")) for rename in pending]
+    elif pending:
+        print(f"Resuming the {len(pending)} renames left by the last run")
+        planned = [(rename.get("source"), rename.get("target")) for rename in pending]
+    else:
+        index = _build_index(section_types)
+        sections = index.sections
+        pending, skipped = _plan_renames(index, workers)
+        if skipped:
+            table = PrettyTable()
+            table.title = "Skipped Renames"
+            table.field_names = ["Item", "Reason"]
+            table.add_rows([[os.path.basename(path), reason] for path, reason in skipped])
+            print(table)
+        planned = [(rename.get("source"), rename.get("target")) for rename in pending]
+        if pending and not dry_run:
+            journal.start(pending)
+
+    if not planned:
+        print("Nothing to roll back" if rollback else "Every item is already named correctly")
+    elif dry_run:
+        for source, target in planned:
+            print(f"Would rename {source} to {target}")
+    else:
+        with metrics.stage("renames"):
+            if rollback:
+                applied, failed = rollback_renames(journal, renames, workers)
+            else:
+                applied, failed = apply_renames(journal, pending, workers)
+        journal.close()
+        manifest = get_manifest()
+        if manifest is not None:
+            for rename in applied:
+                source, target = rename.get("source"), rename.get("target")
+                manifest.move(*((target, source) if rollback else (source, target)))
+        print(f"{'Rolled back' if rollback else 'Renamed'} {len(applied)} items"
+              + (f", {len(failed)} failed" if failed else ""))
+        if failed:
+            table = PrettyTable()
+            table.title = "Failed Renames"
+            table.field_names = ["Item", "Target"]
+            table.add_rows([[os.path.basename(rename.get("target" if rollback else "source")),
+                             os.path.basename(rename.get("source" if rollback else "target"))] for rename in failed])
+            print(table)
+        if applied:
+            _notify_renames(sections or get_plex().get_sections(), applied)
+    _save_manifest()
+    _export_metrics("rename")
+
+
+def _plan_renames(index, workers):
+    """
+    Resolve every item of the index and plan its rename.
+
+    Returns:
+        tuple: The renames and the skipped items, see ``plan_renames``.
+    """
+    from progress.bar import ShadyBar
+    from utils.renamer import plan_renames
+
+    _load_plex_media(index.sections, index.media)
+    get_tmdb()
+    items = [item for entry in index.media for item in index.media.get(entry)]
+    with metrics.stage("resolve"):
+        with ShadyBar('Resolving', fill='#', suffix='%(percent).1f%% - %(eta)ds', max=len(items)) as bar:
+            for _ in run_concurrently(_resolve, items, workers):
                 bar.next()
-    if not is_table_empty(table):
-        print(table)
+    with metrics.stage("plan"):
+        return plan_renames(items)
+
+
+@metrics.stage("notify")
+def _notify_renames(sections, renames):
+    """Send a partial scan of the folders of the renamed items to Plex."""
+    if get_config().get("plex").get("notify") is False:
         return
+    section_ids = {}
+    for section in sections:
+        section_ids.update(section.get("section_ids", {}))
+    folders = dict.fromkeys(os.path.dirname(rename.get("source")) for rename in renames)
+    changes = [(section_ids.get(folder), folder, None) for folder in folders if section_ids.get(folder)]
+    if changes:
+        get_plex().notify_changes(changes)
 
 
-def rename_media():
+def build_title_index(section_types=None, workers=None, dry_run=False):
     """
-    Rename all media.
+    Build the offline title index from the TMDB daily ID exports of the config.
     """
-    pass
+    from services.title_index import TitleIndex, DEFAULT_PATH
+
+    index_config = get_config().get("tmdb").get("title_index") or {}
+    path = index_config.get("path", DEFAULT_PATH)
+    exports = {media_type: export for media_type, export in (index_config.get("exports") or {}).items()
+               if not section_types or media_type in section_types}
+    if not exports:
+        print("No TMDB exports in tmdb.title_index.exports of config.yml")
+        return
+    if dry_run:
+        for media_type, export in exports.items():
+            print(f"Would index the {media_type} titles of {export} into {path}")
+        return
+    try:
+        with metrics.stage("build"):
+            counts = TitleIndex.build(path, exports)
+    except Exception as e:
+        print(f"Couldn't build the title index\n{e}")
+        return
+    for media_type, count in counts.items():
+        print(f"Indexed {count} {media_type} titles into {path}")
+    _export_metrics("build-index")
 
 
-def clear_images():
+def clear_images(section_types=None, workers=None, dry_run=False):
     """
     Clear all downloaded images, posters & backdrops.
     """
-    sections = plex.get_sections()
-    media = get_media(sections)
-    for item in media:
-        section_media = media.get(item)
-        for entry in section_media:
-            delete_images(entry)
+    index = _build_index(section_types)
+    for entry in index.media:
+        for item in index.media.get(entry):
+            for image in item.images:
+                image_path = os.path.join(item.path, image)
+                if dry_run:
+                    print(f"Would delete {image_path}")
+                    continue
+                try:
+                    os.remove(image_path)
+                except Exception as e:
+                    print(e)
+    _save_manifest()
+    _export_metrics("clear-images")
 
 
-def clear_trailers():
+def clear_trailers(section_types=None, workers=None, dry_run=False):
     """
     Clear all downloaded trailers.
     """
-    sections = plex.get_sections()
-    media = get_media(sections)
-    for item in media:
-        section_media = media.get(item)
-        for entry in section_media:
-            delete_trailer(entry)
+    index = _build_index(section_types)
+    for entry in index.media:
+        for item in index.media.get(entry):
+            if item.has_trailers_folder:
+                if dry_run:
+                    print(f"Would delete {os.path.join(item.path, 'Trailers')}")
+                    continue
+                delete_trailer(item.path)
+    _save_manifest()
+    _export_metrics("clear-trailers")
+
+
+def clean_image_store(section_types=None, workers=None, dry_run=False):
+    """
+    Delete the images of the image store that no item uses anymore.
+    """
+    store = get_image_store()
+    if store is None:
+        print("The image store is disabled, enable image_store in config.yml")
+        return
+    with metrics.stage("collect"):
+        deleted, freed = store.collect_garbage(dry_run)
+    action = "Would delete" if dry_run else "Deleted"
+    print(f"{action} {deleted} orphaned images, {freed / 1e6:.1f} MB")
+    print(f"The hardlinks to the image store save {store.get_savings() / 1e6:.1f} MB")
+    _export_metrics("clean-store")
 
 
 def _quit():
@@ -239,7 +803,7 @@ def print_logo():
     """
     print(artwork.ascii_art)
     print("Created by xriskon || Christos Konstantopoulos")
-    print("Version 0.1")
+    print(f"Version {VERSION}")
     print("https://github.com/xriskon\n")
 
 
@@ -253,6 +817,8 @@ def print_list():
     print("[4]\tRename media")
     print("[5]\tClear images")
     print("[6]\tClear trailers")
+    print("[7]\tBuild title index")
+    print("[8]\tClean image store")
     print("[0]\tExit")
 
 
@@ -274,14 +840,84 @@ commands = {
     3: get_trailers,
     4: rename_media,
     5: clear_images,
-    6: clear_trailers
+    6: clear_trailers,
+    7: build_title_index,
+    8: clean_image_store
 }
 
+cli_commands = {
+    "posters": (get_posters, "Download the missing posters"),
+    "backdrops": (get_backdrops, "Download the missing backdrops"),
+    "trailers": (get_trailers, "Download the missing trailers"),
+    "rename": (rename_media, "Rename all media"),
+    "clear-images": (clear_images, "Delete all posters & backdrops"),
+    "clear-trailers": (clear_trailers, "Delete all trailers"),
+    "build-index": (build_title_index, "Build the offline title index from the TMDB daily ID exports"),
+    "clean-store": (clean_image_store, "Delete the images of the image store no item uses anymore"),
+}
+
+
+def build_parser():
+    """
+    Build the parser of the command line interface.
+
+    Returns:
+        argparse.ArgumentParser: The parser, with one subcommand per command.
+    """
+    parser = argparse.ArgumentParser(
+        prog="plex_librarian",
+        description="Organize your Plex media library. Run without a command for the interactive menu."
+    )
+    parser.add_argument("--version", action="version", version=f"%(prog)s {VERSION}")
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    for name, (_, description) in cli_commands.items():
+        subparser = subparsers.add_parser(name, help=description, description=description)
+        subparser.add_argument("-s", "--section", dest="section_types", action="append", choices=["movie", "show"],
+                               help="only process this section type, can be repeated")
+        subparser.add_argument("-w", "--workers", type=int,
+                               help="number of items processed at once, overrides the config")
+        subparser.add_argument("-n", "--dry-run", action="store_true",
+                               help="only print what would be done")
+        subparser.add_argument("--profile", nargs="?", const="profile", metavar="DIR",
+                               help="profile the command, saving the profiles to DIR (default: profile)")
+        if name in ("posters", "backdrops"):
+            subparser.add_argument("-r", "--refresh", action="store_true",
+                                   help="also download the images downloaded before that changed on TMDB")
+        if name == "rename":
+            subparser.add_argument("--rollback", action="store_true",
+                                   help="undo the renames of the last run")
+    return parser
+
+
+def run_command(args):
+    """
+    Run a command parsed from the command line.
 
-def main():
+    Args:
+        args (argparse.Namespace): The parsed arguments.
+    """
+    command, _ = cli_commands.get(args.command)
+    options = {name: getattr(args, name) for name in ("refresh", "rollback") if name in args}
+    if args.profile is None:
+        command(section_types=args.section_types, workers=args.workers, dry_run=args.dry_run, **options)
+        return
+    from utils.profiling import Profiler
+    with Profiler(args.profile):
+        command(section_types=args.section_types, workers=args.workers, dry_run=args.dry_run, **options)
+
+
+def main(argv=None):
     """
     This is main function the program runs off.
+
+    Args:
+        argv (list): The command line arguments, the interactive menu is shown if there is no command.
     """
+    args = build_parser().parse_args(argv)
+    if args.command:
+        run_command(args)
+        return
+
     _clear_screen()
     print_logo()
     print_list()
@@ -304,4 +940,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    main(sys.argv[1:])
@@ -0,0 +1,176 @@
+"""This files contains the persistent cache used to store API responses between runs."""
+
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode
+
+DEFAULT_PATH = "config/cache.db"
+DEFAULT_MAX_ENTRIES = 100000
+DEFAULT_NEGATIVE_TTL = 24 * 60 * 60
+# The number of hits whose access times are kept in memory before they're written
+ACCESS_FLUSH_SIZE = 1000
+DEFAULT_TTL = {
+    "search": 30 * 24 * 60 * 60,
+    "details": 7 * 24 * 60 * 60,
+    "images": 7 * 24 * 60 * 60,
+    "videos": 7 * 24 * 60 * 60,
+}
+
+
+def normalize_request(path, params=None):
+    """
+    Build the cache key of a request.
+
+    The parameters are sorted, empty parameters are dropped and text values are case-folded
+    with their whitespace collapsed, so "The Matrix" and " the  matrix" share one entry.
+
+    Args:
+        path (str): The path of the endpoint.
+        params (dict): The query parameters of the request.
+
+    Returns:
+        str: The cache key.
+    """
+    items = []
+    for key, value in sorted((params or {}).items()):
+        if value is None:
+            continue
+        if isinstance(value, str):
+            value = " ".join(value.split()).casefold()
+        items.append((key, value))
+    if not items:
+        return path
+    return f"{path}?{urlencode(items)}"
+
+
+class ResponseCache:
+    """
+    SQLite backed cache of API responses.
+
+    Every entry expires after the TTL of its endpoint. Entries for requests that returned
+    no results are stored as negative entries with a shorter TTL, so known failures are not
+    retried on every run. The cache is bounded to ``max_entries``, evicting the least
+    recently used entries first.
+
+    Hits only read the database. Their access times are kept in memory and written in one
+    transaction with the next writes, once enough of them pile up, or when the program exits.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, max_entries=DEFAULT_MAX_ENTRIES, ttl=None, negative_ttl=DEFAULT_NEGATIVE_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = dict(DEFAULT_TTL, **(ttl or {}))
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._accessed = {}
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        # Readers don't wait for writers and commits don't sync the database on every write
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT, negative INTEGER, expires REAL, accessed REAL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._connection.commit()
+        atexit.register(self.flush)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create the cache from the ``cache`` entry of a service config.
+
+        Returns:
+            ResponseCache: The cache, None if it's disabled.
+        """
+        cache_config = config.get("cache") or {}
+        if cache_config.get("enabled") is False:
+            return None
+        return cls(
+            path=cache_config.get("path", DEFAULT_PATH),
+            max_entries=cache_config.get("max_entries", DEFAULT_MAX_ENTRIES),
+            ttl=cache_config.get("ttl"),
+            negative_ttl=cache_config.get("negative_ttl", DEFAULT_NEGATIVE_TTL),
+        )
+
+    def get(self, key):
+        """
+        Get a cached response.
+
+        Args:
+            key (str): The normalized request.
+
+        Returns:
+            tuple: True and the cached value if there is a fresh entry, (False, None) otherwise.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, expires FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return False, None
+            value, expires = row
+            # Expired entries are replaced by the next response or evicted
+            if expires < now:
+                return False, None
+            self._accessed[key] = now
+            if len(self._accessed) >= ACCESS_FLUSH_SIZE:
+                self._flush_accessed()
+                self._connection.commit()
+        return True, json.loads(value)
+
+    def set(self, key, value, endpoint, negative=False):
+        """
+        Store a response.
+
+        Args:
+            key (str): The normalized request.
+            value: The JSON serializable response.
+            endpoint (str): The endpoint of the request, used to pick the TTL.
+            negative (bool): True if the request had no results.
+        """
+        now = time.time()
+        ttl = self.negative_ttl if negative else self.ttl.get(endpoint, self.negative_ttl)
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, negative, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(value), int(negative), now + ttl, now)
+            )
+            self._writes += 1
+            self._flush_accessed()
+            # Check the size bound every so often, counting rows on every write is too slow
+            if self._writes % 100 == 0:
+                self._evict(now)
+            self._connection.commit()
+
+    def flush(self):
+        """Write the access times of the hits kept in memory."""
+        with self._lock:
+            if self._accessed:
+                self._flush_accessed()
+                self._connection.commit()
+
+    def _flush_accessed(self):
+        if self._accessed:
+            self._connection.executemany("UPDATE responses SET accessed = ? WHERE key = ?",
+                                         [(accessed, key) for key, accessed in self._accessed.items()])
+            self._accessed = {}
+
+    def _evict(self, now):
+        self._connection.execute("DELETE FROM responses WHERE expires < ?", (now,))
+        count = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count > self.max_entries:
+            self._connection.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed LIMIT ?)",
+                (count - self.max_entries,)
+            )
@@ -1,13 +1,29 @@
 """This files contains the agent used to communicate with Plex."""
+import json
+import os
+from xml.etree.ElementTree import iterparse
 import xmltodict
-import requests
+from utils import metrics, transport
 from utils.tools import *
 
+PAGE_SIZE = 500
+MAX_CONCURRENCY = 2
+# The number of changed folders under one root from which the whole root is scanned instead
+ROOT_SCAN_THRESHOLD = 20
+LIST_ELEMENTS = ("Directory", "Location", "Video", "Media", "Part", "Guid")
+# The elements of the items of a section, movies are videos and TV shows are directories
+ITEM_ELEMENTS = ("Video", "Directory")
+
 
 class Plex:
     def __init__(self, config):
         self.token = config.get("plex").get("token")
         self.url = config.get("plex").get("server_url")
+        self.page_size = config.get("plex").get("page_size", PAGE_SIZE)
+        self.max_concurrency = config.get("plex").get("max_concurrency", MAX_CONCURRENCY)
+        self.root_scan_threshold = config.get("plex").get("root_scan_threshold", ROOT_SCAN_THRESHOLD)
+        # The format of the section items, "xml" is streamed while "json" is parsed a page at a time
+        self.format = config.get("plex").get("format", "xml")
 
     def get_sections(self):
         url = f'{self.url}/library/sections'
@@ -15,32 +31,40 @@ class Plex:
 
         # Get Plex response
         try:
-            response = requests.get(url, headers=headers)
+            with metrics.timer("plex_request_duration_seconds", endpoint="sections"):
+                response = transport.get(url, headers=headers)
             if response.status_code != 200:
                 return 1
         except Exception as e:
             print(e)
             return 1
-        result = xmltodict.parse(response.content).get("MediaContainer").get("Directory")
+        result = xmltodict.parse(response.content, force_list=LIST_ELEMENTS).get("MediaContainer").get("Directory", [])
         movie = {
             "type": "movie",
             "id": None,
-            "path": []
+            "ids": [],
+            "path": [],
+            "section_ids": {}
         }
         show = {
             "type": "show",
             "id": None,
-            "path": []
+            "ids": [],
+            "path": [],
+            "section_ids": {}
         }
         for section in result:
-            paths = section.get("Location")
-            for path in paths:
-                if section.get("@type") == "movie":
-                    movie["id"] = section.get("@key")
-                    movie.get("path").append(path.get("@path"))
-                elif section.get("@type") == "show":
-                    show["id"] = section.get("@key")
-                    show.get("path").append(path.get("@path"))
+            if section.get("@type") == "movie":
+                entry = movie
+            elif section.get("@type") == "show":
+                entry = show
+            else:
+                continue
+            entry["id"] = section.get("@key")
+            entry.get("ids").append(section.get("@key"))
+            for path in section.get("Location", []):
+                entry.get("path").append(path.get("@path"))
+                entry.get("section_ids")[path.get("@path")] = section.get("@key")
 
         if not movie.get("path"):
             sections = [show]
@@ -50,11 +74,221 @@ class Plex:
             sections = [movie, show]
         return sections
 
-    def get_media(self):
-        pass
+    def get_media(self, section_id):
+        """
+        Get every item of a section with its TMDB ID, if Plex matched it.
+
+        The section is fetched in pages of ``page_size`` items. The XML of a page is parsed while it
+        downloads and each item is yielded as soon as its element ends, then dropped, so the memory
+        used stays flat whatever the size of the section or of the pages. With the "json" format the
+        pages are parsed whole, so their size bounds the memory used.
+
+        Args:
+            section_id (str): The key of the section.
+
+        Yields:
+            dict: The rating key, title, year, TMDB ID, folder path and file of each item, stopping
+                early if a request fails.
+        """
+        url = f"{self.url}/library/sections/{section_id}/all"
+        start = 0
+        while True:
+            headers = {
+                'X-Plex-Token': self.token,
+                'X-Plex-Container-Start': str(start),
+                'X-Plex-Container-Size': str(self.page_size)
+            }
+            if self.format == "json":
+                headers["Accept"] = "application/json"
+            page = {}
+            count = 0
+            try:
+                # Streamed responses are timed until their headers arrive
+                with metrics.timer("plex_request_duration_seconds", endpoint="media"):
+                    response = transport.get(url, params={"includeGuids": 1}, headers=headers, stream=True)
+                with response:
+                    if response.status_code != 200:
+                        print(f"Couldn't get the media of section {section_id}: HTTP {response.status_code}")
+                        return
+                    parse = self._parse_json_page if self.format == "json" else self._parse_xml_page
+                    for item in parse(response, page):
+                        count += 1
+                        yield item
+            except Exception as e:
+                print(e)
+                return
 
-    def scan_library(self):
-        pass
+            start += count
+            if not count or start >= page.get("total", 0):
+                return
+
+    def scan_library(self, section_id, path=None):
+        """
+        Scan a section for new and changed files.
+
+        Args:
+            section_id (str): The key of the section.
+            path (str): Only scan this folder of the section, the whole section if None.
+
+        Returns:
+            bool: True if Plex accepted the request, False otherwise.
+        """
+        url = f"{self.url}/library/sections/{section_id}/refresh"
+        return self._send("GET", url, {"path": path} if path else None, endpoint="scan")
 
     def refresh_metadata(self, section_id):
-        url = f"{self.url}/library/sections/{section_id}/refresh?force=1&X-Plex-Token={self.token}"
+        """Force a metadata refresh of a whole section."""
+        url = f"{self.url}/library/sections/{section_id}/refresh"
+        return self._send("GET", url, {"force": 1}, endpoint="refresh_section")
+
+    def refresh_item(self, rating_key):
+        """Refresh the metadata of a single item, picking up its new local artwork."""
+        url = f"{self.url}/library/metadata/{rating_key}/refresh"
+        return self._send("PUT", url, endpoint="refresh_item")
+
+    def notify_changes(self, changes):
+        """
+        Tell Plex about the folders changed by a run.
+
+        The items Plex already knows only need a metadata refresh to pick up their new artwork. The
+        folders of the other items are scanned with one partial scan per folder, skipping folders inside
+        another changed folder, or with one scan of their root once ``root_scan_threshold`` folders of
+        the root changed. At most ``max_concurrency`` requests are sent to Plex at once.
+
+        Args:
+            changes (list): A tuple of section key, folder path and rating key (None if unknown) per changed item.
+        """
+        from utils.workers import run_concurrently
+
+        folders = {}
+        rating_keys = set()
+        for section_id, folder, rating_key in changes:
+            if rating_key is not None:
+                rating_keys.add(rating_key)
+            else:
+                folders[os.path.normpath(folder)] = section_id
+        roots = {}
+        for folder, section_id in folders.items():
+            roots.setdefault((section_id, os.path.dirname(folder)), []).append(folder)
+        for (section_id, root), root_folders in roots.items():
+            if len(root_folders) >= self.root_scan_threshold:
+                for folder in root_folders:
+                    del folders[folder]
+                folders[root] = section_id
+        scans = [(section_id, folder) for folder, section_id in folders.items()
+                 if not _has_ancestor(folder, folders)]
+
+        calls = [(self.scan_library, scan) for scan in scans]
+        calls += [(self.refresh_item, (rating_key,)) for rating_key in sorted(rating_keys)]
+        results = run_concurrently(lambda call: call[0](*call[1]), calls, self.max_concurrency)
+        failed = sum(1 for _, ok in results if not ok)
+        print(f"Sent {len(scans)} partial scans and {len(rating_keys)} metadata refreshes to Plex"
+              + (f", {failed} failed" if failed else ""))
+
+    def _send(self, method, url, params=None, endpoint=None):
+        headers = {'X-Plex-Token': self.token}
+        try:
+            with metrics.timer("plex_request_duration_seconds", endpoint=endpoint):
+                response = transport.request(method, url, params=params, headers=headers)
+            if response.status_code != 200:
+                print(f"Plex request failed: {method} {url} HTTP {response.status_code}")
+                return False
+        except Exception as e:
+            print(e)
+            return False
+        return True
+
+    @staticmethod
+    def _parse_xml_page(response, page):
+        """
+        Parse a page of section items in XML while it downloads.
+
+        Args:
+            response (requests.Response): The streamed response.
+            page (dict): Receives the "total" number of items of the section.
+
+        Yields:
+            dict: The compact record of each item.
+        """
+        response.raw.decode_content = True
+        container = None
+        depth = 0
+        for event, element in iterparse(response.raw, events=("start", "end")):
+            if event == "start":
+                if container is None:
+                    container = element
+                    page["total"] = int(element.get("totalSize", element.get("size", 0)))
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1 and element.tag in ITEM_ELEMENTS:
+                yield _get_item(
+                    element.get("ratingKey"), element.get("title"), element.get("year"),
+                    [guid.get("id") for guid in element.iterfind("Guid")],
+                    [part.get("file") for part in element.iterfind("Media/Part")],
+                    [location.get("path") for location in element.iterfind("Location")]
+                )
+                # Drop the parsed items, the container would keep them otherwise
+                container.clear()
+
+    @staticmethod
+    def _parse_json_page(response, page):
+        """Parse a page of section items in JSON, see ``_parse_xml_page``."""
+        container = json.loads(response.content).get("MediaContainer") or {}
+        page["total"] = int(container.get("totalSize", container.get("size", 0)))
+        for element in container.get("Metadata", []):
+            yield _get_item(
+                element.get("ratingKey"), element.get("title"), element.get("year"),
+                [guid.get("id") for guid in element.get("Guid", [])],
+                [part.get("file") for media in element.get("Media", []) for part in media.get("Part", [])],
+                [location.get("path") for location in element.get("Location", [])]
+            )
+
+
+def _get_item(rating_key, title, year, guids, files, locations):
+    """
+    Get the compact record of an item of a section.
+
+    Args:
+        rating_key (str): The rating key of the item.
+        title (str): The title of the item.
+        year (str): The release year of the item, None if unknown.
+        guids (list): The IDs of the item in the agents, e.g. "tmdb://603".
+        files (list): The files of the media of the item.
+        locations (list): The folders of the item, for TV shows.
+
+    Returns:
+        dict: The rating key, title, year, TMDB ID, folder path and file of the item.
+    """
+    tmdb_id = None
+    for guid in guids:
+        if guid and guid.startswith("tmdb://"):
+            tmdb_id = int(guid[len("tmdb://"):])
+            break
+
+    file = files[0] if files else None
+    if locations:
+        path = locations[0]
+    elif file:
+        path = os.path.dirname(file)
+    else:
+        path = None
+
+    return {
+        "rating_key": str(rating_key) if rating_key is not None else None,
+        "title": title,
+        "year": int(year) if year else None,
+        "tmdb_id": tmdb_id,
+        "path": path,
+        "file": file
+    }
+
+
+def _has_ancestor(folder, folders):
+    """Check if any parent of a folder is in the given folders."""
+    parent = os.path.dirname(folder)
+    while parent and parent != folder:
+        if parent in folders:
+            return True
+        folder, parent = parent, os.path.dirname(parent)
+    return False
@@ -0,0 +1,247 @@
+"""This files contains the offline index of the TMDB titles, built from the daily ID exports."""
+
+import gzip
+import json
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from utils.tools import get_string_similarity
+
+DEFAULT_PATH = "config/titles.db"
+# The fields holding the title of an entry of the movie and TV series exports
+TITLE_FIELDS = {"movie": ("original_title", "title"), "show": ("original_name", "name")}
+MIN_SIMILARITY = 0.9
+MIN_MARGIN = 0.05
+# How much more popular the most popular of several titles must be to be picked without a year
+MIN_POPULARITY_RATIO = 10
+MAX_CANDIDATES = 50
+QUERY_TRIGRAMS = 8
+BATCH_SIZE = 10000
+
+
+def normalize_title(title):
+    """
+    Normalize a title for lookups.
+
+    Accents and punctuation are dropped, "&" becomes "and" and the title is case-folded with its
+    whitespace collapsed, so "Amélie" and "amelie", or "Fast & Furious" and "Fast and Furious" match.
+
+    Args:
+        title (str): The title.
+
+    Returns:
+        str: The normalized title.
+    """
+    title = unicodedata.normalize("NFKD", title or "")
+    title = "".join(char for char in title if not unicodedata.combining(char))
+    title = title.casefold().replace("&", " and ")
+    title = re.sub(r"[^\w\s]", " ", title)
+    return " ".join(title.split())
+
+
+def get_title_similarity(title1, title2):
+    """
+    Score how similar two titles are, using their Levenshtein distance.
+
+    Returns:
+        float: 1 for the same normalized title, down to 0 for completely different titles.
+    """
+    title1 = normalize_title(title1)
+    title2 = normalize_title(title2)
+    longest = max(len(title1), len(title2))
+    if not longest:
+        return 0.0
+    return 1 - get_string_similarity(title1, title2) / longest
+
+
+def _get_trigrams(normalized):
+    padded = f"  {normalized} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TitleIndex:
+    """
+    SQLite index of the titles in the TMDB daily ID exports.
+
+    The exports only hold the original title and the popularity of every movie and TV series, so a
+    title is only resolved locally when it's unambiguous: one exact match, or one match much more
+    popular than the others when the release year is unknown, or one fuzzy match found through the
+    trigram index that is clearly better than the rest. Everything else is left to the search API.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Open the index from the ``title_index`` entry of the TMDB config.
+
+        Returns:
+            TitleIndex: The index, None if it's disabled or wasn't built yet.
+        """
+        index_config = config.get("title_index") or {}
+        path = index_config.get("path", DEFAULT_PATH)
+        if index_config.get("enabled") is False or not os.path.exists(path):
+            return None
+        return cls(path)
+
+    @staticmethod
+    def build(path, exports):
+        """
+        Build the index from TMDB daily ID exports, replacing the previous one atomically.
+
+        Args:
+            path (str): The path of the index.
+            exports (dict): The path of the gzip JSONL export of each media type (movie, show).
+
+        Returns:
+            dict: The number of titles indexed per media type.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{path}.tmp"
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        connection = sqlite3.connect(temp_path)
+        counts = {}
+        try:
+            connection.execute("CREATE TABLE titles (id INTEGER PRIMARY KEY, tmdb_id INTEGER, media_type TEXT, "
+                               "title TEXT, normalized TEXT, year INTEGER, popularity REAL)")
+            connection.execute("CREATE TABLE trigrams (trigram TEXT, title_id INTEGER)")
+            for media_type, export_path in exports.items():
+                counts[media_type] = _load_export(connection, media_type, export_path)
+            connection.execute("CREATE INDEX titles_normalized ON titles (media_type, normalized)")
+            connection.execute("CREATE INDEX trigrams_trigram ON trigrams (trigram, title_id)")
+            connection.execute("CREATE TABLE trigram_counts (trigram TEXT PRIMARY KEY, count INTEGER)")
+            connection.execute("INSERT INTO trigram_counts SELECT trigram, COUNT(*) FROM trigrams GROUP BY trigram")
+            connection.commit()
+        finally:
+            connection.close()
+        os.replace(temp_path, path)
+        return counts
+
+    def lookup(self, title, year=None, media_type="movie"):
+        """
+        Resolve a title to its TMDB ID without going to the network.
+
+        Args:
+            title (str): The title of the movie/TV show.
+            year (int): The release year, optional.
+            media_type (str): The type of the media (movie OR show)
+
+        Returns:
+            int: The TMDB ID, None if the title isn't in the index or is ambiguous.
+        """
+        normalized = normalize_title(title)
+        if not normalized:
+            return None
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT tmdb_id, year, popularity FROM titles WHERE media_type = ? AND normalized = ?",
+                (media_type, normalized)
+            ).fetchall()
+        if rows:
+            return _pick_exact(rows, year)
+        return self._lookup_fuzzy(normalized, year, media_type)
+
+    def _lookup_fuzzy(self, normalized, year, media_type):
+        # The rarest trigrams of the title are enough to gather the candidates, the common ones match too many titles
+        trigrams = list(_get_trigrams(normalized))
+        with self._lock:
+            placeholders = ",".join("?" * len(trigrams))
+            rare = [row[0] for row in self._connection.execute(
+                f"SELECT trigram FROM trigram_counts WHERE trigram IN ({placeholders}) ORDER BY count LIMIT ?",
+                trigrams + [QUERY_TRIGRAMS]
+            )]
+            if not rare:
+                return None
+            placeholders = ",".join("?" * len(rare))
+            candidates = self._connection.execute(
+                f"SELECT titles.tmdb_id, titles.normalized, titles.year FROM titles JOIN ("
+                f"SELECT title_id, COUNT(*) AS shared FROM trigrams WHERE trigram IN ({placeholders}) "
+                f"GROUP BY title_id ORDER BY shared DESC LIMIT ?) AS matches ON titles.id = matches.title_id "
+                f"WHERE titles.media_type = ?",
+                rare + [MAX_CANDIDATES, media_type]
+            ).fetchall()
+        scored = sorted(((get_title_similarity(normalized, candidate), tmdb_id, candidate_year)
+                         for tmdb_id, candidate, candidate_year in candidates), reverse=True)
+        if year is not None:
+            scored = [entry for entry in scored if entry[2] is None or abs(entry[2] - year) <= 1]
+        if not scored or scored[0][0] < MIN_SIMILARITY:
+            return None
+        if len(scored) > 1 and scored[0][0] - scored[1][0] < MIN_MARGIN:
+            return None
+        # Without the year of the candidates a fuzzy match could be any movie with a similar title
+        if year is not None and scored[0][2] is None:
+            return None
+        return scored[0][1]
+
+    def close(self):
+        self._connection.close()
+
+
+def _pick_exact(rows, year):
+    """Pick the TMDB ID of the exact matches of a title, None if it's ambiguous."""
+    if year is not None:
+        dated = [row for row in rows if row[1] is not None]
+        if dated:
+            rows = [row for row in dated if abs(row[1] - year) <= 1]
+            return rows[0][0] if len(rows) == 1 else None
+    if len(rows) == 1:
+        return rows[0][0]
+    if year is not None:
+        # Several titles and no year to tell them apart, e.g. a remake
+        return None
+    rows = sorted(rows, key=lambda row: row[2] or 0, reverse=True)
+    if (rows[0][2] or 0) >= MIN_POPULARITY_RATIO * max(rows[1][2] or 0, 0.001):
+        return rows[0][0]
+    return None
+
+
+def _load_export(connection, media_type, export_path):
+    """
+    Load the titles of a gzip JSONL export into the index.
+
+    Returns:
+        int: The number of titles loaded.
+    """
+    fields = TITLE_FIELDS.get(media_type, ("title",))
+    count = 0
+    next_id = (connection.execute("SELECT MAX(id) FROM titles").fetchone()[0] or 0) + 1
+    titles = []
+    trigrams = []
+    with gzip.open(export_path, "rt", encoding="utf-8") as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            # Skip the compilations and extras of the movie export
+            if entry.get("video"):
+                continue
+            title = next((entry.get(field) for field in fields if entry.get(field)), None)
+            normalized = normalize_title(title)
+            if not normalized:
+                continue
+            date = entry.get("release_date") or entry.get("first_air_date") or ""
+            year = entry.get("year") or (int(date[:4]) if date[:4].isdigit() else None)
+            titles.append((next_id, entry.get("id"), media_type, title, normalized, year, entry.get("popularity")))
+            trigrams.extend((trigram, next_id) for trigram in _get_trigrams(normalized))
+            next_id += 1
+            count += 1
+            if len(titles) >= BATCH_SIZE:
+                _insert(connection, titles, trigrams)
+                titles, trigrams = [], []
+    _insert(connection, titles, trigrams)
+    return count
+
+
+def _insert(connection, titles, trigrams):
+    connection.executemany("INSERT INTO titles VALUES (?, ?, ?, ?, ?, ?, ?)", titles)
+    connection.executemany("INSERT INTO trigrams VALUES (?, ?)", trigrams)
@@ -2,9 +2,22 @@
 
 import json
 import os
-import requests
+from services.cache import ResponseCache, normalize_request
+from services.title_index import TitleIndex, get_title_similarity
+from utils import metrics, transport
 from utils.tools import *
 
+API_URL = "https://api.themoviedb.org/3"
+IMAGE_URL = "https://image.tmdb.org/t/p"
+BACKDROP_LANGUAGES = ["en", "null"]
+# The sizes served by the image CDN, from the smallest to the largest
+IMAGE_SIZES = {
+    "poster": ["w92", "w154", "w185", "w342", "w500", "w780", "original"],
+    "backdrop": ["w300", "w780", "w1280", "original"]
+}
+# The most entries TMDB accepts in append_to_response
+APPEND_LIMIT = 20
+
 
 class TMDB:
     def __init__(self, config):
@@ -14,68 +27,188 @@ class TMDB:
             "Authorization": F"Bearer {self.key}"
         }
         self.image_language = config.get("tmdb").get("image_language")
+        self.cache = ResponseCache.from_config(config.get("tmdb"))
+        self.title_index = TitleIndex.from_config(config.get("tmdb"))
+        self.api_url = config.get("tmdb").get("api_url", API_URL)
+        self.image_url = config.get("tmdb").get("image_url", IMAGE_URL)
+        # A size per kind of image, either one of IMAGE_SIZES or the minimum width in pixels
+        self.image_sizes = config.get("tmdb").get("image_sizes") or {}
 
-    def get_poster(self, tmdb_id, media_type):
-        """Get the poster URL."""
+    def get_media_bundle(self, tmdb_id, media_type, language="en-US"):
+        """
+        Get the details, images and videos of a movie/TV show in a single request.
+
+        The images include every language used for posters and backdrops, so the same
+        payload can be used to pick any of the artwork and the trailer.
+
+        Args:
+            tmdb_id (int): The ID of the movie/TV show
+            media_type (str): The type of the media provided (movie OR show)
+            language (str): The language of the details and videos
+        Returns:
+            dict: The details with the "images" and "videos" appended, None otherwise
+        """
         if media_type == "movie":
-            url = f"https://api.themoviedb.org/3/movie/{tmdb_id}/images?include_image_language={self.image_language}"
+            path = f"/movie/{tmdb_id}"
         elif media_type == "show":
-            url = f"https://api.themoviedb.org/3/tv/{tmdb_id}/images?include_image_language={self.image_language}"
+            path = f"/tv/{tmdb_id}"
         else:
             return None
 
+        image_languages = self._poster_languages()
+        image_languages += [lang for lang in BACKDROP_LANGUAGES if lang not in image_languages]
+        params = {
+            "append_to_response": "images,videos",
+            "include_image_language": ",".join(image_languages),
+            "language": language
+        }
         try:
-            response = requests.get(url, headers=self.headers)
-            if response.status_code == 200:
-                posters = json.loads(response.content).get("posters")
-                return posters[0].get("file_path")
+            return self._get(path, params, endpoint="details")
         except Exception as e:
             return None
 
+    def get_poster(self, tmdb_id, media_type):
+        """Get the poster, see ``pick_poster``."""
+        bundle = self.get_media_bundle(tmdb_id, media_type)
+        return self.pick_poster(bundle)
+
     def get_backdrop(self, tmdb_id, media_type):
-        if media_type == "movie":
-            url = f"https://api.themoviedb.org/3/movie/{tmdb_id}/images?include_image_language=en%2Cnull"
-        elif media_type == "show":
-            url = f"https://api.themoviedb.org/3/tv/{tmdb_id}/images?include_image_language=en%2Cnull"
-        else:
-            return None
+        bundle = self.get_media_bundle(tmdb_id, media_type)
+        return self.pick_backdrop(bundle)
+
+    def get_trailer(self, tmdb_id, media_type, language="en-US"):
+        bundle = self.get_media_bundle(tmdb_id, media_type, language)
+        return self.pick_trailer(bundle)
+
+    def get_season_posters(self, tmdb_id, seasons):
+        """
+        Get the posters of the seasons of a TV show.
+
+        The images of up to 20 seasons are appended to a single request of the TV show details,
+        so a show is fetched in one request instead of one per season.
+
+        Args:
+            tmdb_id (int): The ID of the TV show
+            seasons (list): The season numbers, 0 for the specials
+        Returns:
+            dict: The poster of each season that has one, by season number
+        """
+        seasons = sorted(set(seasons))
+        params = {
+            "include_image_language": ",".join(self._poster_languages()),
+            "language": "en-US"
+        }
+        posters = {}
+        for start in range(0, len(seasons), APPEND_LIMIT):
+            chunk = seasons[start:start + APPEND_LIMIT]
+            params["append_to_response"] = ",".join(f"season/{season}/images" for season in chunk)
+            try:
+                result = self._get(f"/tv/{tmdb_id}", dict(params), endpoint="details")
+            except Exception as e:
+                continue
+            if not result:
+                continue
+            for season in chunk:
+                poster = self._pick_image({"images": result.get(f"season/{season}/images")}, "posters",
+                                          self._poster_languages(), self._get_min_width("poster"))
+                if poster is not None:
+                    posters[season] = poster
+        return posters
+
+    def pick_poster(self, bundle):
+        """
+        Pick the poster from a media bundle.
+
+        Returns:
+            dict: The image of the poster, with its file path, width and height, None otherwise
+        """
+        return self._pick_image(bundle, "posters", self._poster_languages(), self._get_min_width("poster"))
+
+    def pick_backdrop(self, bundle):
+        """
+        Pick the backdrop from a media bundle.
+
+        Returns:
+            dict: The image of the backdrop, with its file path, width and height, None otherwise
+        """
+        return self._pick_image(bundle, "backdrops", BACKDROP_LANGUAGES, self._get_min_width("backdrop"))
+
+    def get_image_url(self, image, kind):
+        """
+        Get the URL of an image at the size configured for its kind.
+
+        With a minimum width, the smallest size at least that wide is used, or the original
+        if the image isn't any wider.
+
+        Args:
+            image (dict): The image as returned by ``pick_poster`` or ``pick_backdrop``.
+            kind (str): The kind of the image (poster OR backdrop)
+        Returns:
+            str: The URL of the image
+        """
+        size = self.image_sizes.get(kind, "original")
+        min_width = self._get_min_width(kind)
+        if min_width is not None:
+            size = "original"
+            width = image.get("width") or 0
+            for tier in IMAGE_SIZES.get(kind, []):
+                if tier != "original" and min_width <= int(tier[1:]) < width:
+                    size = tier
+                    break
+        return f"{self.image_url}/{size}{image.get('file_path')}"
+
+    def pick_trailer(self, bundle):
+        """
+        Pick the trailer from a media bundle, preferring the official one.
 
+        Returns:
+            str: The YouTube key of the trailer, None otherwise
+        """
         try:
-            response = requests.get(url, headers=self.headers)
-            if response.status_code == 200:
-                posters = json.loads(response.content).get("backdrops")
-                return posters[0].get("file_path")
-        except Exception as e:
-            return None
+            videos = bundle.get("videos").get("results")
+            trailers = [obj for obj in videos if obj["type"] == "Trailer"]
+            if len(trailers) == 1:
+                return trailers[0].get("key")
+            sorted_trailers = sorted(trailers, key=lambda x: x["size"])
+            for trailer in sorted_trailers:
+                if self._find_official_trailer(trailer.get("name")):
+                    return trailer.get("key")
+            return sorted_trailers[0].get("key")
 
-    def get_trailer(self, tmdb_id, media_type, language="en-US"):
-        if media_type == "movie":
-            url = f"https://api.themoviedb.org/3/movie/{tmdb_id}/videos?language={language}"
-        elif media_type == "show":
-            url = f"https://api.themoviedb.org/3/tv/{tmdb_id}/videos?language={language}"
-        else:
+        except Exception as e:
             return None
 
+    def _pick_image(self, bundle, kind, languages, min_width=None):
         try:
-            response = requests.get(url, headers=self.headers)
-            if response.status_code == 200:
-                videos = json.loads(response.content).get("results")
-                trailers = [obj for obj in videos if obj["type"] == "Trailer"]
-                if len(trailers) == 1:
-                    return trailers[0].get("key")
-                sorted_trailers = sorted(trailers, key=lambda x: x["size"])
-                for trailer in sorted_trailers:
-                    if self._find_official_trailer(trailer.get("name")):
-                        return trailer.get("key")
-                return sorted_trailers[0].get("key")
-
+            images = [image for image in bundle.get("images").get(kind)
+                      if (image.get("iso_639_1") or "null") in languages]
         except Exception as e:
             return None
+        if not images:
+            return None
+        # Prefer the first image wide enough, the first one otherwise
+        if min_width is not None:
+            for image in images:
+                if (image.get("width") or 0) >= min_width:
+                    return image
+        return images[0]
+
+    def _get_min_width(self, kind):
+        size = self.image_sizes.get(kind)
+        return size if isinstance(size, int) else None
+
+    def _poster_languages(self):
+        if not self.image_language:
+            return list(BACKDROP_LANGUAGES)
+        return [lang.strip() for lang in self.image_language.split(",")]
 
     def search(self, title, release_year=None, media_type=None, tmdb_id=None, include_adult=True, language="en-US"):
         """
         Search for a movie/TV Show in TMDB
 
+        The offline title index is tried first, the search API is only used for the titles
+        it can't resolve on its own.
+
         Args:
             title (str): Title of the movie/TV show
             release_year (int): Primary release year of the movie/TV show
@@ -88,7 +221,13 @@ class TMDB:
         """
         if media_type is None:
             return None
-        elif media_type == "movie":
+        if tmdb_id is None and self.title_index is not None:
+            local_id = self.title_index.lookup(title, release_year, media_type)
+            metrics.increment("title_index_lookups_total", media_type=media_type,
+                              result="miss" if local_id is None else "hit")
+            if local_id is not None:
+                return local_id
+        if media_type == "movie":
             return self.search_movie(title, release_year, tmdb_id, include_adult, language)
         elif media_type == "show":
             return self.search_show(title, release_year, tmdb_id, include_adult, language)
@@ -108,51 +247,118 @@ class TMDB:
             return self._search_show_title(movie_title, release_year, include_adult, language)
 
     def _search_show_id(self, tmdb_id, language="en-US"):
-        url = f"https://api.themoviedb.org/3/movie/{tmdb_id}?language={language}"
         try:
-            response = requests.get(url, headers=self.headers)
-            if response.status_code == 200:
-                result = json.loads(response.content)
-                return result.get("id")
+            result = self._get(f"/tv/{tmdb_id}", {"language": language}, endpoint="details")
+            return result.get("id")
         except Exception as e:
             print(e)
             return None
 
     def _search_show_title(self, show_title, release_year=None, include_adult=True, language="en-US"):
-        url = f"https://api.themoviedb.org/3/search/tv?query={show_title}&first_air_date_year={release_year}&include_adult={include_adult}&language={language}&page=1"
-
+        params = {
+            "query": show_title,
+            "first_air_date_year": release_year,
+            "include_adult": str(include_adult).lower(),
+            "language": language,
+            "page": 1
+        }
         try:
-            response = requests.get(url, headers=self.headers)
-            if response.status_code == 200:
-                result = json.loads(response.content).get("results")[0]
-                return result.get("id")
+            result = self._get("/search/tv", params, endpoint="search")
+            return self._pick_result(result.get("results"), show_title, release_year, ("name", "original_name"),
+                                     "first_air_date")
         except Exception as e:
             print(e)
             return None
 
     def _search_movie_id(self, tmdb_id, language="en-US"):
-        url = f"https://api.themoviedb.org/3/tv/{tmdb_id}?language={language}"
-
         try:
-            response = requests.get(url, headers=self.headers)
-            if response.status_code == 200:
-                result = json.loads(response.content)
-                return result.get("id")
+            result = self._get(f"/movie/{tmdb_id}", {"language": language}, endpoint="details")
+            return result.get("id")
         except Exception as e:
             print(e)
             return None
 
     def _search_movie_title(self, movie_title, release_year=None, include_adult=True, language="en-US"):
-        url = f"https://api.themoviedb.org/3/search/movie?query={movie_title}&include_adult={include_adult}&language={language}&primary_release_year={release_year}&page=1"
+        params = {
+            "query": movie_title,
+            "include_adult": str(include_adult).lower(),
+            "language": language,
+            "primary_release_year": release_year,
+            "page": 1
+        }
         try:
-            response = requests.get(url, headers=self.headers)
-            if response.status_code == 200:
-                result = json.loads(response.content).get("results")[0]
-                return result.get("id")
+            result = self._get("/search/movie", params, endpoint="search")
+            return self._pick_result(result.get("results"), movie_title, release_year, ("title", "original_title"),
+                                     "release_date")
         except Exception as e:
             print(e)
             return None
 
+    @staticmethod
+    def _pick_result(results, title, release_year, title_fields, date_field):
+        """
+        Pick the search result closest to the title and release year.
+
+        TMDB sorts the results by popularity, which only breaks the ties.
+
+        Returns:
+            int: The ID of the best result, None if there are no results
+        """
+        best_id = None
+        best_score = None
+        for position, result in enumerate(results or []):
+            score = max(get_title_similarity(title, result.get(field) or "") for field in title_fields)
+            if release_year is not None and (result.get(date_field) or "")[:4] == str(release_year):
+                score += 0.1
+            score -= position * 0.001
+            if best_score is None or score > best_score:
+                best_id, best_score = result.get("id"), score
+        return best_id
+
+    def _get(self, path, params=None, endpoint=None):
+        """
+        Send a GET request to the TMDB API, going through the response cache.
+
+        Args:
+            path (str): The path of the endpoint, e.g. "/search/movie".
+            params (dict): The query parameters.
+            endpoint (str): The kind of endpoint (search, details, images, videos), used to pick the cache TTL.
+
+        Returns:
+            dict: The response, None if the request failed or had no results.
+        """
+        key = normalize_request(path, params)
+        if self.cache is not None:
+            hit, result = self.cache.get(key)
+            metrics.increment("tmdb_cache_requests_total", endpoint=endpoint, result="hit" if hit else "miss")
+            if hit:
+                return result
+
+        with metrics.timer("tmdb_request_duration_seconds", endpoint=endpoint):
+            response = transport.get(f"{self.api_url}{path}", params=params, headers=self.headers)
+        metrics.increment("tmdb_requests_total", endpoint=endpoint, status=response.status_code)
+        if response.status_code == 404:
+            result = None
+        elif response.status_code == 200:
+            result = json.loads(response.content)
+        else:
+            # Don't cache errors that may go away, e.g. rate limits
+            return None
+
+        if self.cache is not None:
+            self.cache.set(key, result, endpoint, negative=self._is_negative(result))
+        return result
+
+    @staticmethod
+    def _is_negative(result):
+        """Check if a response has no results."""
+        if not result:
+            return True
+        for field in ("results", "posters", "backdrops"):
+            if field in result and result.get(field):
+                return False
+        return any(field in result for field in ("results", "posters", "backdrops"))
+
     def _find_official_trailer(self, name):
         if "official trailer" in name.lower():
             return True
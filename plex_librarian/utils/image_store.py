@@ -0,0 +1,252 @@
+"""This file contains the image store, the content-addressed copy of every downloaded image."""
+
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit
+from utils import metrics
+from utils.tools import download_image
+
+DEFAULT_PATH = "config/images"
+# The ioctl cloning a file on Btrfs and XFS, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+def get_image_key(url):
+    """
+    Get the key of an image in the store from its URL.
+
+    TMDB never changes the image of a file path, a new image gets a new one, so the size tier and
+    file path, e.g. "w500/abc.jpg", identify the bytes of an image.
+
+    Args:
+        url (str): The URL of the image on the TMDB image CDN.
+
+    Returns:
+        str: The size tier and file path of the image.
+    """
+    return "/".join(urlsplit(url).path.split("/")[-2:])
+
+
+class ImageStore:
+    """
+    Content-addressed store of the downloaded images.
+
+    Every image is downloaded once into ``blobs``, named after the SHA-256 of its content, and the
+    item folders get a hardlink to it, a reflink where hardlinks aren't possible, or a copy as a last
+    resort. So the editions of a movie, or a show split across library roots, share one download and,
+    for hardlinks and reflinks, one copy on disk. A SQLite index maps the key of every image to its blob.
+    The store must be on the same filesystem as the library for hardlinks.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.bytes_saved = 0
+        self.links = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        os.makedirs(os.path.join(path, "blobs"), exist_ok=True)
+        os.makedirs(os.path.join(path, "downloads"), exist_ok=True)
+        self._connection = sqlite3.connect(os.path.join(path, "index.db"), timeout=30, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS images (key TEXT PRIMARY KEY, hash TEXT, size INTEGER, "
+                                 "stored REAL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS images_hash ON images (hash)")
+        self._connection.commit()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Open the store from the ``image_store`` entry of the config.
+
+        Returns:
+            ImageStore: The store, None unless it's enabled.
+        """
+        store_config = config.get("image_store") or {}
+        if not store_config.get("enabled"):
+            return None
+        return cls(store_config.get("path", DEFAULT_PATH))
+
+    def fetch(self, url, destination, validators=None):
+        """
+        Save an image to a destination, downloading it only if it isn't in the store yet.
+
+        Args:
+            url (str): The URL of the image.
+            destination (str): The path where the image will be saved.
+            validators (dict): The validators of the destination, see ``download_image``.
+
+        Returns:
+            str: "downloaded" if the destination changed, "unchanged" if it already was the image, None if it failed.
+        """
+        key = get_image_key(url)
+        # Two editions of a movie processed at once download the image only once
+        with self._get_key_lock(key):
+            blob = self._get_blob(key)
+            downloaded = blob is None
+            if downloaded:
+                blob = self._download(key, url, validators)
+                if blob is None:
+                    return None
+        try:
+            if os.path.exists(destination) and os.path.samefile(blob, destination):
+                return "unchanged"
+            method = _link(blob, destination)
+        except OSError as e:
+            print(f"Couldn't link {blob} to {destination}\n{e}")
+            return None
+        metrics.increment("image_store_links_total", method=method)
+        if not downloaded:
+            size = os.path.getsize(blob)
+            metrics.increment("image_store_bytes_saved_total", size)
+            with self._lock:
+                self.bytes_saved += size
+                self.links += 1
+        if validators is not None:
+            validators.update(url=url, complete=True)
+        return "downloaded"
+
+    def collect_garbage(self, dry_run=False):
+        """
+        Delete the blobs no item links to anymore, and their entries.
+
+        A blob whose only link is the store itself is orphaned. Items that got a reflink or a copy of
+        a blob don't count as links, their blobs are deleted and downloaded again if needed.
+
+        Args:
+            dry_run (bool): Only count what would be deleted.
+
+        Returns:
+            tuple: The number of blobs deleted and the bytes freed.
+        """
+        deleted = 0
+        freed = 0
+        for blob in self._get_blobs():
+            try:
+                stat = os.stat(blob)
+            except OSError:
+                continue
+            if stat.st_nlink > 1:
+                continue
+            if dry_run:
+                print(f"Would delete {blob}")
+            else:
+                digest = os.path.splitext(os.path.basename(blob))[0]
+                with self._lock:
+                    self._connection.execute("DELETE FROM images WHERE hash = ?", (digest,))
+                    self._connection.commit()
+                os.remove(blob)
+            deleted += 1
+            freed += stat.st_size
+        return deleted, freed
+
+    def get_savings(self):
+        """
+        Get the disk space saved by the hardlinks to the blobs.
+
+        Returns:
+            int: The bytes the linked items would take as separate copies.
+        """
+        saved = 0
+        for blob in self._get_blobs():
+            try:
+                stat = os.stat(blob)
+            except OSError:
+                continue
+            # The first item link takes the place of the blob
+            saved += stat.st_size * max(0, stat.st_nlink - 2)
+        return saved
+
+    def close(self):
+        self._connection.close()
+
+    def _get_key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _get_blob(self, key):
+        """Get the path of the blob of an image, None if it isn't stored."""
+        with self._lock:
+            row = self._connection.execute("SELECT hash FROM images WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        blob = self._get_blob_path(row[0], os.path.splitext(key)[1])
+        return blob if os.path.exists(blob) else None
+
+    def _get_blob_path(self, digest, ext):
+        return os.path.join(self.path, "blobs", digest[:2], f"{digest}{ext}")
+
+    def _get_blobs(self):
+        blobs_path = os.path.join(self.path, "blobs")
+        for directory in os.listdir(blobs_path):
+            with os.scandir(os.path.join(blobs_path, directory)) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        yield entry.path
+
+    def _download(self, key, url, validators):
+        """
+        Download an image into the store.
+
+        Returns:
+            str: The path of its blob, None if the download failed.
+        """
+        download_path = os.path.join(self.path, "downloads", key.replace("/", "_"))
+        if download_image(url, download_path, validators) is None:
+            return None
+        digest = hashlib.sha256()
+        with open(download_path, "rb") as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+        blob = self._get_blob_path(digest, os.path.splitext(key)[1])
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        # The same bytes under another key are stored once, keeping the links to the existing blob
+        if os.path.exists(blob):
+            os.remove(download_path)
+        else:
+            os.replace(download_path, blob)
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)",
+                                     (key, digest, os.path.getsize(blob), time.time()))
+            self._connection.commit()
+        return blob
+
+
+def _link(source, destination):
+    """
+    Replace the destination with a hardlink to the source, a reflink or a copy if the filesystem can't link it.
+
+    Returns:
+        str: How the file was linked (hardlink, reflink or copy).
+    """
+    temp_path = os.path.join(os.path.dirname(destination), f".{os.path.basename(destination)}.link")
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    try:
+        os.link(source, temp_path)
+        method = "hardlink"
+    except OSError:
+        method = "reflink" if _reflink(source, temp_path) else "copy"
+        if method == "copy":
+            shutil.copyfile(source, temp_path)
+    os.replace(temp_path, destination)
+    return method
+
+
+def _reflink(source, destination):
+    """Clone a file on filesystems supporting it, e.g. Btrfs and XFS."""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+        return True
+    except OSError:
+        if os.path.exists(destination):
+            os.remove(destination)
+        return False
@@ -0,0 +1,333 @@
+"""This file contains the library index, a single-pass snapshot of every media folder."""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils import metrics
+from utils.names import parse_movie_name, parse_season_folder, parse_show_name
+from utils.tools import is_image_file, is_video_file
+from utils.workers import run_concurrently
+
+# The number of item folders scanned at once per root, each scan is a few round trips on SMB/NFS
+DEFAULT_SCAN_WORKERS = 8
+
+
+# The assets of an item, as flags
+POSTER = 1
+BACKDROP = 2
+TRAILER = 4
+TRAILERS_FOLDER = 8
+
+
+class MediaItem:
+    """
+    Compact record of an item of the library, built once per run and shared by every command.
+
+    The assets found in the item folder are kept as flags, the name of the item is parsed the first
+    time its title is needed and the TMDB ID, once resolved, is kept for the rest of the run.
+    ``seasons`` holds the number, folder name and whether there's a poster of every season folder.
+    """
+
+    __slots__ = ("path", "section", "is_dir", "assets", "images", "seasons", "rating_key", "title", "year",
+                 "tmdb_id", "_parsed")
+
+    def __init__(self, path, section, state):
+        """
+        Args:
+            path (str): The path of the item.
+            section (str): The section type of the item (movie OR show).
+            state (dict): The state of the item found by the scan.
+        """
+        self.path = path
+        self.section = section
+        self.is_dir = state.get("is_dir", True)
+        images = state.get("images") or {}
+        trailers = state.get("trailers")
+        self.assets = ((POSTER if _has_artwork(images, "poster") else 0)
+                       | (BACKDROP if _has_artwork(images, "backdrop") else 0)
+                       | (TRAILER if trailers else 0)
+                       | (TRAILERS_FOLDER if trailers is not None else 0))
+        seasons = state.get("seasons") or {}
+        # The paths of the images relative to the item folder, only the season posters of the season folders
+        self.images = tuple(images) + tuple(os.path.join(name, filename) for name, season in seasons.items()
+                                            for filename in season.get("images")
+                                            if _is_season_poster(filename, season.get("season")))
+        self.seasons = tuple(sorted((season.get("season"), name, _has_season_poster(season))
+                                    for name, season in seasons.items()))
+        self.rating_key = None
+        self.title = None
+        self.year = None
+        self.tmdb_id = None
+        self._parsed = False
+
+    def __repr__(self):
+        return f"MediaItem({self.path!r}, {self.section!r})"
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+    @property
+    def has_poster(self):
+        """Check if the item has a non-empty poster image."""
+        return bool(self.assets & POSTER)
+
+    @property
+    def has_backdrop(self):
+        """Check if the item has a non-empty backdrop image."""
+        return bool(self.assets & BACKDROP)
+
+    @property
+    def has_trailer(self):
+        """Check if the item has a video inside its "Trailers" folder."""
+        return bool(self.assets & TRAILER)
+
+    @property
+    def has_trailers_folder(self):
+        """Check if the item has a "Trailers" folder, even an empty one."""
+        return bool(self.assets & TRAILERS_FOLDER)
+
+    def parse(self):
+        """
+        Parse the title, release year and TMDB ID from the name of the item, only the first time.
+
+        Returns:
+            bool: True if the name matched a naming convention of its section type.
+        """
+        if self._parsed:
+            return self.title is not None
+        self._parsed = True
+        if self.section == "movie":
+            result = parse_movie_name(self.name)
+        elif self.section == "show":
+            result = parse_show_name(self.name)
+        else:
+            return False
+        if result is None:
+            return False
+        self.title = result.title
+        self.year = result.year
+        if self.tmdb_id is None:
+            self.tmdb_id = getattr(result, "tmdb_id", None)
+        return True
+
+    def set_plex_item(self, plex_item):
+        """
+        Complete the item with what Plex knows about it, the name of the item taking precedence.
+
+        Args:
+            plex_item (dict): The item as returned by ``Plex.get_media``.
+        """
+        self.rating_key = plex_item.get("rating_key")
+        if not self.parse():
+            self.title = plex_item.get("title")
+            self.year = plex_item.get("year")
+        if self.tmdb_id is None:
+            self.tmdb_id = plex_item.get("tmdb_id")
+
+
+class LibraryIndex:
+    """
+    Snapshot of the library built with one ``os.scandir`` walk of every root, the roots and their
+    item folders being scanned in parallel.
+
+    ``media`` maps each section type to its items, in the order of the root listings, while ``items``
+    maps the path of every item to its ``MediaItem``. ``sections`` are the sections the index was
+    built from and ``scan_times`` the seconds each of their roots took to scan.
+    """
+
+    def __init__(self):
+        self.sections = []
+        self.media = {}
+        self.items = {}
+        self.scan_times = {}
+
+
+def build_library_index(sections, manifest=None, workers=DEFAULT_SCAN_WORKERS, root_workers=None):
+    """
+    Build the library index for the given sections.
+
+    With a manifest, only the item folders whose inode or modification time changed since the
+    last run are scanned again, the state of the others is taken from the manifest. Every root is
+    scanned at the same time, each with its own pool of ``workers`` threads scanning its item folders,
+    so the round trips to network filesystems overlap.
+
+    Args:
+        sections (list): The sections as returned by ``Plex.get_sections``.
+        manifest (Manifest): The manifest of the last run, optional.
+        workers (int): The number of item folders scanned at once per root.
+        root_workers (dict): The number of item folders scanned at once for some roots, by path.
+
+    Returns:
+        LibraryIndex: The index of every item in the sections.
+    """
+    index = LibraryIndex()
+    index.sections = sections
+    root_workers = root_workers or {}
+    roots = list(dict.fromkeys((path, section.get("type")) for section in sections for path in section.get("path")))
+    with ThreadPoolExecutor(max_workers=max(1, len(roots))) as executor:
+        scans = {root: executor.submit(_scan_root, *root, manifest, root_workers.get(root[0], workers))
+                 for root in roots}
+        for section in sections:
+            section_items = []
+            for path in section.get("path"):
+                items, elapsed = scans.get((path, section.get("type"))).result()
+                index.items.update(items)
+                section_items.extend(items.values())
+                index.scan_times[path] = elapsed
+                metrics.set_gauge("scan_root_duration_seconds", elapsed, root=path)
+            index.media[section.get("type")] = section_items
+    if manifest is not None:
+        manifest.prune(index.items, [path for path, _ in roots])
+    return index
+
+
+def _scan_root(path, section_type, manifest, workers):
+    """
+    Scan the items of a library root.
+
+    Returns:
+        tuple: Every item by path, in the order of the root listing, and the seconds the scan took.
+    """
+    started = time.perf_counter()
+    items = {}
+    folders = []
+    # The type of each entry comes with the listing, so only the item folders cost more round trips
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                items[entry.path] = None
+                folders.append(entry)
+            elif entry.is_file() and is_video_file(entry.name):
+                items[entry.path] = MediaItem(entry.path, section_type, {"is_dir": False})
+    for entry, state in run_concurrently(lambda _entry: _get_item(_entry, manifest), folders, workers):
+        items[entry.path] = MediaItem(entry.path, section_type, state)
+    return items, time.perf_counter() - started
+
+
+def _get_item(entry, manifest):
+    """
+    Get the state of an item folder, from the manifest if the folder is unchanged.
+
+    Args:
+        entry (os.DirEntry): The item folder.
+        manifest (Manifest): The manifest of the last run, optional.
+
+    Returns:
+        dict: The state of the item.
+    """
+    if manifest is None:
+        return _scan_item(entry.path)
+    stat = entry.stat()
+    record = manifest.get(entry.path)
+    if (record and record.get("inode") == stat.st_ino and record.get("mtime") == stat.st_mtime_ns
+            and _are_subfolders_unchanged(entry.path, record.get("state"))):
+        return record.get("state")
+    state = _scan_item(entry.path)
+    manifest.update(entry.path, inode=stat.st_ino, mtime=stat.st_mtime_ns, state=state)
+    return state
+
+
+def _are_subfolders_unchanged(directory, state):
+    """
+    Check if the "Trailers" and season folders of an item are unchanged.
+
+    Changes inside them don't touch the modification time of the item folder, so they're checked on their own.
+    """
+    # States saved before season folders were indexed have no "seasons"
+    if state is None or "seasons" not in state:
+        return False
+    subfolders = [("Trailers", state.get("trailers_mtime"))]
+    subfolders += [(name, season.get("mtime")) for name, season in state.get("seasons").items()]
+    for name, mtime in subfolders:
+        if mtime is None:
+            continue
+        try:
+            if os.stat(os.path.join(directory, name)).st_mtime_ns != mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def _scan_item(directory):
+    """
+    Scan an item folder for images and trailers.
+
+    Args:
+        directory (str): The path of the item folder.
+
+    Returns:
+        dict: The images found with their sizes, the videos of the "Trailers" folder, if there is one,
+            and the season poster of every season folder.
+    """
+    images = {}
+    trailers = None
+    trailers_mtime = None
+    seasons = {}
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file() and is_image_file(entry.name):
+                    images[entry.name] = entry.stat().st_size
+                elif entry.name == "Trailers" and entry.is_dir():
+                    trailers = _scan_trailers(entry.path)
+                    trailers_mtime = entry.stat().st_mtime_ns
+                elif entry.is_dir():
+                    season = parse_season_folder(entry.name)
+                    if season is not None:
+                        seasons[entry.name] = {"season": season, "images": _scan_season_posters(entry.path, season),
+                                               "mtime": entry.stat().st_mtime_ns}
+    except OSError as e:
+        print(e)
+    return {"is_dir": True, "images": images, "trailers": trailers, "trailers_mtime": trailers_mtime,
+            "seasons": seasons}
+
+
+def _scan_season_posters(directory, season):
+    """Scan a season folder for its poster, leaving the episode thumbnails and other images alone."""
+    try:
+        with os.scandir(directory) as entries:
+            return {entry.name: entry.stat().st_size for entry in entries
+                    if entry.is_file() and is_image_file(entry.name) and _is_season_poster(entry.name, season)}
+    except OSError as e:
+        print(e)
+        return {}
+
+
+def _scan_trailers(directory):
+    with os.scandir(directory) as entries:
+        return [entry.name for entry in entries if entry.is_file() and is_video_file(entry.name)]
+
+
+def get_season_poster_name(season):
+    """
+    Get the filename Plex expects for the poster of a season, without the extension.
+
+    Args:
+        season (int): The season number, 0 for the specials.
+
+    Returns:
+        str: The name of the poster inside the season folder, e.g. "Season01".
+    """
+    if season == 0:
+        return "season-specials-poster"
+    return f"Season{season:02d}"
+
+
+def _has_artwork(images, prefix):
+    for filename, size in images.items():
+        if filename.lower().startswith(prefix) and size != 0:
+            return True
+    return False
+
+
+def _has_season_poster(season):
+    for filename, size in season.get("images").items():
+        if _is_season_poster(filename, season.get("season")) and size != 0:
+            return True
+    return False
+
+
+def _is_season_poster(filename, season):
+    return os.path.splitext(filename)[0].lower() == get_season_poster_name(season).lower()
@@ -0,0 +1,127 @@
+"""This file contains the manifest, the persisted state of every item folder between runs."""
+
+import json
+import os
+import threading
+
+DEFAULT_PATH = "config/manifest.json"
+VERSION = 1
+
+
+class Manifest:
+    """
+    Persisted record of every item folder.
+
+    Each record holds the inode and modification time of the folder when it was last scanned,
+    the artwork and trailers found in it, the TMDB ID it was resolved to and the ETag and
+    Last-Modified of its downloaded artwork. Folders whose
+    inode and modification time are unchanged don't need to be scanned again.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.items = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create the manifest from the ``manifest`` entry of the config.
+
+        Returns:
+            Manifest: The manifest, None if it's disabled.
+        """
+        manifest_config = config.get("manifest") or {}
+        if manifest_config.get("enabled") is False:
+            return None
+        return cls(manifest_config.get("path", DEFAULT_PATH))
+
+    def get(self, item):
+        """Get the record of an item, None if it was never scanned."""
+        with self._lock:
+            return self.items.get(item)
+
+    def update(self, item, **fields):
+        """
+        Update the record of an item.
+
+        Args:
+            item (str): The path of the item.
+            **fields: The fields to set, e.g. inode, mtime, state or tmdb_id.
+        """
+        with self._lock:
+            self.items.setdefault(item, {}).update(fields)
+
+    def get_tmdb_id(self, item):
+        """Get the TMDB ID an item was resolved to, None otherwise."""
+        record = self.get(item)
+        return record.get("tmdb_id") if record else None
+
+    def set_tmdb_id(self, item, tmdb_id):
+        self.update(item, tmdb_id=tmdb_id)
+
+    def get_validators(self, item, name):
+        """
+        Get the validators of the last download of an artwork of an item.
+
+        Args:
+            item (str): The path of the item.
+            name (str): The name of the artwork, e.g. poster.
+
+        Returns:
+            dict: The validators, created empty if unknown, to be updated in place by ``download_image``.
+        """
+        with self._lock:
+            return self.items.setdefault(item, {}).setdefault("artwork", {}).setdefault(name, {})
+
+    def move(self, item, new_item):
+        """Move the record of an item to its new path, after it was renamed."""
+        with self._lock:
+            record = self.items.pop(item, None)
+            if record is not None:
+                self.items[new_item] = record
+
+    def prune(self, items, roots):
+        """
+        Drop the records of the items that no longer exist.
+
+        Only the items of the scanned roots are dropped, so scanning some sections keeps the records
+        of the others.
+
+        Args:
+            items (iterable): The paths of the items found in the last scan.
+            roots (iterable): The library roots of the last scan.
+        """
+        items = set(items)
+        roots = {os.path.normpath(root) for root in roots}
+        with self._lock:
+            self.items = {item: record for item, record in self.items.items()
+                          if item in items or os.path.dirname(item) not in roots}
+
+    def save(self):
+        """Write the manifest to disk, replacing the previous one atomically."""
+        with self._lock:
+            data = {"version": VERSION, "items": self.items}
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temp_path = f"{self.path}.tmp"
+            try:
+                with open(temp_path, "w", encoding="utf-8") as file:
+                    json.dump(data, file)
+                os.replace(temp_path, self.path)
+            except Exception as e:
+                print(f"Couldn't save the manifest\n{e}")
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+        except Exception as e:
+            print(f"Couldn't load the manifest, starting from scratch\n{e}")
+            return
+        if data.get("version") == VERSION:
+            self.items = data.get("items") or {}
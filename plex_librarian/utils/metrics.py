@@ -0,0 +1,233 @@
+"""This file contains the metrics registry, the counters and timings recorded during a run."""
+
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+PREFIX = "plex_librarian_"
+DEFAULT_JSON_PATH = "config/metrics.json"
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_counters = {}
+_gauges = {}
+_histograms = {}
+_lock = threading.Lock()
+
+
+def increment(name, value=1, **labels):
+    """
+    Increment a counter.
+
+    Args:
+        name (str): The name of the counter, e.g. "http_requests_total".
+        value (float): The amount to add.
+        **labels: The labels of the series, e.g. endpoint="search".
+    """
+    key = _get_key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """Set a gauge to a value."""
+    key = _get_key(name, labels)
+    with _lock:
+        _gauges[key] = value
+
+
+def observe(name, value, **labels):
+    """
+    Record a value, usually a duration in seconds, in a histogram.
+
+    Args:
+        name (str): The name of the histogram, e.g. "tmdb_request_duration_seconds".
+        value (float): The value to record.
+        **labels: The labels of the series.
+    """
+    key = _get_key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"buckets": [0] * len(BUCKETS), "count": 0, "sum": 0.0}
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram["buckets"][i] += 1
+                break
+        histogram["count"] += 1
+        histogram["sum"] += value
+
+
+@contextmanager
+def timer(name, **labels):
+    """Record the duration of the block in a histogram."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+@contextmanager
+def stage(name):
+    """Record the duration of a stage of the running command, e.g. the scan or the downloads."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        key = _get_key("stage_duration_seconds", {"stage": name})
+        with _lock:
+            _gauges[key] = _gauges.get(key, 0) + elapsed
+
+
+def reset():
+    """Drop every recorded metric."""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+def snapshot():
+    """
+    Get every recorded metric.
+
+    Returns:
+        dict: The counters, gauges and histograms, each a list of series with their name, labels and values.
+    """
+    with _lock:
+        return {
+            "counters": [_get_series(key, value=value) for key, value in sorted(_counters.items())],
+            "gauges": [_get_series(key, value=value) for key, value in sorted(_gauges.items())],
+            "histograms": [_get_series(key, count=histogram.get("count"), sum=histogram.get("sum"),
+                                       buckets=dict(zip(BUCKETS, histogram.get("buckets"))))
+                           for key, histogram in sorted(_histograms.items())]
+        }
+
+
+def to_prometheus(labels=None):
+    """
+    Format every recorded metric in the Prometheus text format.
+
+    Args:
+        labels (dict): Labels added to every series, e.g. the command.
+
+    Returns:
+        str: The metrics, ready for the textfile collector of node_exporter.
+    """
+    labels = labels or {}
+    data = snapshot()
+    lines = []
+    for kind, series_type in (("counters", "counter"), ("gauges", "gauge")):
+        for name, series in _group(data.get(kind)):
+            lines.append(f"# TYPE {PREFIX}{name} {series_type}")
+            for entry in series:
+                lines.append(f"{PREFIX}{name}{_format_labels(labels, entry.get('labels'))} {entry.get('value')}")
+    for name, series in _group(data.get("histograms")):
+        lines.append(f"# TYPE {PREFIX}{name} histogram")
+        for entry in series:
+            series_labels = dict(labels, **entry.get("labels"))
+            cumulative = 0
+            for bound, count in entry.get("buckets").items():
+                cumulative += count
+                lines.append(f"{PREFIX}{name}_bucket{_format_labels(series_labels, {'le': bound})} {cumulative}")
+            lines.append(f"{PREFIX}{name}_bucket{_format_labels(series_labels, {'le': '+Inf'})} {entry.get('count')}")
+            lines.append(f"{PREFIX}{name}_sum{_format_labels(series_labels)} {entry.get('sum')}")
+            lines.append(f"{PREFIX}{name}_count{_format_labels(series_labels)} {entry.get('count')}")
+    return "\n".join(lines) + "\n"
+
+
+def summary():
+    """
+    Get a one line summary of the stage timings.
+
+    Returns:
+        str: The duration of each stage, None if no stage was recorded.
+    """
+    with _lock:
+        # In the order the stages ran
+        stages = [(dict(labels).get("stage"), value) for (name, labels), value in _gauges.items()
+                  if name == "stage_duration_seconds"]
+    if not stages:
+        return None
+    return "Stages: " + ", ".join(f"{stage} {value:.2f} s" for stage, value in stages)
+
+
+def export(config, command=None):
+    """
+    Write the recorded metrics to the files of the ``metrics`` entry of the config.
+
+    The metrics are written as JSON to ``metrics.json`` and, if ``metrics.prometheus`` is set, in the
+    Prometheus text format to that file. Every command has its own files, named after the configured
+    paths and the command, e.g. ``metrics_posters.json`` and ``plex_librarian_posters.prom``, so the
+    commands run by separate cron jobs don't replace the reports of each other. The files are replaced
+    atomically.
+
+    Args:
+        config (dict): The loaded config.yml.
+        command (str): The command of the run, added to every series.
+    """
+    metrics_config = config.get("metrics") or {}
+    if metrics_config.get("enabled") is False:
+        return
+    labels = {"command": command} if command else {}
+    set_gauge("last_run_timestamp_seconds", time.time())
+    data = dict(labels, finished=time.time(), **snapshot())
+    _write(_get_command_path(metrics_config.get("json", DEFAULT_JSON_PATH), command), json.dumps(data, indent=2))
+    if metrics_config.get("prometheus"):
+        _write(_get_command_path(metrics_config.get("prometheus"), command), to_prometheus(labels))
+
+
+def _get_command_path(path, command):
+    """Get the path of the file of a command, e.g. "metrics_posters.json" for "metrics.json"."""
+    if not command:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}_{re.sub(r'[^A-Za-z0-9_]', '_', command)}{ext}"
+
+
+def _write(path, content):
+    directory = os.path.dirname(path)
+    # Overlapping runs of a command don't share the temporary file
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(temp_path, "w", encoding="utf-8") as file:
+            file.write(content)
+        os.replace(temp_path, path)
+    except Exception as e:
+        print(f"Couldn't write the metrics to {path}\n{e}")
+
+
+def _get_key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _get_series(key, **values):
+    name, labels = key
+    return dict(name=name, labels=dict(labels), **values)
+
+
+def _group(series):
+    groups = {}
+    for entry in series:
+        groups.setdefault(entry.get("name"), []).append(entry)
+    return groups.items()
+
+
+def _format_labels(*label_sets):
+    labels = {}
+    for label_set in label_sets:
+        labels.update(label_set or {})
+    if not labels:
+        return ""
+    values = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        values.append(f'{key}="{value}"')
+    return "{" + ",".join(values) + "}"
@@ -0,0 +1,181 @@
+"""This file contains the parsers used to read the title, year and other info from media filenames."""
+
+import re
+from functools import lru_cache
+from typing import NamedTuple, Optional
+
+# Regular expression patterns to match different naming conventions, in order of priority
+MOVIE_PATTERNS = [
+    r'(?P<title>.+?)\s*\((?P<year>\d{4})\)\s*{tmdb-(?P<tmdb_id>\d+)}',
+    r'(?P<title>.+?)\s*\((?P<year>\d{4})\)',
+    r'(?P<title>.+?)\s*\((?P<year>\d{4})\)\s*-\s*(?P<resolution>\d+p)',
+    r'(?P<title>.+?)\.(?P<year>\d{4})\.(?P<resolution>\d+p)',
+    r'(?P<title>.+?)\s*\((?P<year>\d{4})\)\s*-\s*(?P<codec>[a-zA-Z0-9]+)',
+    r'(?P<title>.+?)\.(?P<year>\d{4})\.(?P<codec>[a-zA-Z0-9]+)',
+    r'(?P<title>.+?)\s*\((?P<year>\d{4})\)\s*-\s*(?P<language>[a-zA-Z]+)',
+    r'(?P<title>.+?)\.(?P<year>\d{4})\.(?P<language>[a-zA-Z]+)',
+    r'(?P<title>.+?)\.(?P<year>\d{4})\s*{tmdb-(?P<tmdb_id>\d+)}',
+]
+
+SHOW_PATTERNS = [
+    r'(?P<title>.+?)\.S(?P<season>\d{2})',
+    r'(?P<title>.+?)\s*\((?P<year>\d{4})\)',
+    r'(?P<title>.+?)\.S(?P<season>\d{2})E(?P<episode>\d{2})',
+    r'(?P<title>.+?)\s*-\s*S(?P<season>\d{2})E(?P<episode>\d{2})',
+    r'(?P<title>.+?)\.S(?P<season>\d{2})E(?P<episode>\d{1,2})',
+    r'(?P<title>.+?)\.(?P<year>\d{4})\.(?P<month>\d{2})\.(?P<day>\d{2})',
+    r'(?P<title>.+?)\.Season(?P<season>\d+)',
+    r'(?P<title>.+?)\.S(?P<season>\d{2})',
+    r'(?P<title>.+?)\s*Complete',
+]
+
+# The names of the season folders of a show, "Specials" being season 0
+SEASON_FOLDER_PATTERN = re.compile(r'(?:season|series|saison|staffel|s)\s*(\d{1,4})|(specials)', re.IGNORECASE)
+
+CACHE_SIZE = 1 << 17
+
+
+class MovieName(NamedTuple):
+    title: str
+    year: int
+    resolution: Optional[str] = None
+    codec: Optional[str] = None
+    language: Optional[str] = None
+    tmdb_id: Optional[int] = None
+
+
+class ShowName(NamedTuple):
+    title: str
+    season: Optional[int] = None
+    episode: Optional[int] = None
+    year: Optional[int] = None
+    month: Optional[int] = None
+    day: Optional[int] = None
+    complete: bool = False
+
+
+class _Matcher:
+    """
+    Ordered set of patterns compiled into a single regular expression.
+
+    Every pattern becomes one branch of an alternation, with its groups renamed to be unique.
+    The branches are tried in order at the start of the string, so the first pattern that
+    matches wins, exactly like trying each pattern with ``re.match`` in turn.
+
+    Each pattern also needs some literal text to match, e.g. "{tmdb-" or "(". Branches whose
+    literals are missing from a filename can't match it, so they are left out of the regex
+    used for that filename. There are only a few combinations of literals, so the regex of
+    each combination is compiled once and reused.
+    """
+
+    def __init__(self, patterns, fields):
+        self.branches = []
+        self.groups = []
+        self.literals = []
+        for i, pattern in enumerate(patterns):
+            names = re.findall(r'\(\?P<(\w+)>', pattern)
+            # Group of each field in the branch, None for the fields the pattern doesn't capture
+            self.groups.append(tuple(f"p{i}_{field}" if field in names else None for field in fields))
+            branch = re.sub(r'\(\?P<(\w+)>', lambda m: f"(?P<p{i}_{m.group(1)}>", pattern)
+            self.branches.append(f"(?P<p{i}>{branch})")
+            self.literals.append(_get_literals(pattern))
+        self.all_literals = sorted(set().union(*self.literals))
+        self._indexes = {f"p{i}": i for i in range(len(patterns))}
+        self._compile = lru_cache(maxsize=None)(self._compile_branches)
+
+    def match(self, filename):
+        """
+        Match a filename against the patterns.
+
+        Returns:
+            tuple: The value of each field and the matched text of the first matching pattern, None otherwise.
+        """
+        present = frozenset(filter(filename.__contains__, self.all_literals))
+        regex = self._compile(present)
+        if regex is None:
+            return None
+        match = regex.match(filename)
+        if match is None:
+            return None
+        branch = match.lastgroup
+        groups = self.groups[self._indexes[branch]]
+        return [match.group(group) if group else None for group in groups], match.group(branch)
+
+    def _compile_branches(self, present):
+        branches = [branch for branch, literals in zip(self.branches, self.literals) if literals <= present]
+        if not branches:
+            return None
+        return re.compile("|".join(branches))
+
+
+def _get_literals(pattern):
+    """
+    Get the literal text a pattern needs to match.
+
+    The patterns only use flat named groups, ``\\s`` and escaped characters outside of groups,
+    so whatever is left after removing those is literal text.
+    """
+    outside = re.sub(r'\(\?P<\w+>[^)]*\)|\\s[*+]?', '\0', pattern)
+    outside = re.sub(r'\\(.)', r'\1', outside)
+    return frozenset(literal for literal in outside.split('\0') if literal)
+
+
+_movie_matcher = _Matcher(MOVIE_PATTERNS, ("title", "year", "resolution", "codec", "language", "tmdb_id"))
+_show_matcher = _Matcher(SHOW_PATTERNS, ("title", "season", "episode", "year", "month", "day"))
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_movie_name(filename):
+    """
+    Parse the filename of a movie.
+
+    Args:
+        filename (str): The name of the movie file or folder.
+
+    Returns:
+        MovieName: The parsed info, None if no pattern matches.
+    """
+    result = _movie_matcher.match(filename)
+    if result is None:
+        return None
+    (title, year, resolution, codec, language, tmdb_id), _ = result
+    return MovieName(title.replace('.', ' '), int(year), resolution, codec, language, _to_int(tmdb_id))
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_show_name(filename):
+    """
+    Parse the filename of a TV show.
+
+    Args:
+        filename (str): The name of the show file or folder.
+
+    Returns:
+        ShowName: The parsed info, None if no pattern matches.
+    """
+    result = _show_matcher.match(filename)
+    if result is None:
+        return None
+    (title, season, episode, year, month, day), text = result
+    return ShowName(title.replace('.', ' '), _to_int(season), _to_int(episode), _to_int(year), _to_int(month),
+                    _to_int(day), 'Complete' in text)
+
+
+def parse_season_folder(name):
+    """
+    Parse the name of a season folder, e.g. "Season 01" or "Specials".
+
+    Args:
+        name (str): The name of the folder.
+
+    Returns:
+        int: The season number, None if it isn't a season folder.
+    """
+    match = SEASON_FOLDER_PATTERN.fullmatch(name.strip())
+    if match is None:
+        return None
+    return 0 if match.group(2) else int(match.group(1))
+
+
+def _to_int(value):
+    return int(value) if value is not None else None
@@ -0,0 +1,113 @@
+"""This file contains the profiler used to find the hotspots of a command."""
+
+import cProfile
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+
+DEFAULT_TOP = 20
+DEFAULT_INTERVAL = 0.005
+
+
+class Profiler:
+    """
+    Profiles a command with cProfile and a wall-clock sampler at the same time.
+
+    cProfile records every call of every thread, including the worker threads, and is saved as a
+    pstats dump. The sampler records the stack of every thread every ``interval`` seconds, so the
+    time spent waiting on the network or on ffmpeg shows up too, and is saved as collapsed stacks,
+    the input of flamegraph.pl and speedscope. Use it as a context manager around the command.
+    """
+
+    def __init__(self, directory="profile", top=DEFAULT_TOP, interval=DEFAULT_INTERVAL):
+        self.directory = directory
+        self.top = top
+        self.interval = interval
+        self.samples = Counter()
+        self._profile = cProfile.Profile()
+        self._thread_profiles = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+        self._sampler.start()
+        threading.setprofile(self._profile_thread)
+        self._profile.enable()
+
+    def stop(self):
+        """Stop profiling, save the profiles and print the hotspots."""
+        self._profile.disable()
+        threading.setprofile(None)
+        self._stop.set()
+        self._sampler.join()
+
+        stats = pstats.Stats(self._profile)
+        with self._lock:
+            for profile in self._thread_profiles:
+                profile.disable()
+                stats.add(profile)
+        os.makedirs(self.directory, exist_ok=True)
+        stats_path = os.path.join(self.directory, "profile.pstats")
+        stacks_path = os.path.join(self.directory, "profile.collapsed")
+        stats.dump_stats(stats_path)
+        with open(stacks_path, "w", encoding="utf-8") as file:
+            for stack, count in self.samples.most_common():
+                file.write(f"{stack} {count}\n")
+
+        print(f"\nTop {self.top} functions by own time:")
+        stats.sort_stats("tottime").print_stats(self.top)
+        print(f"Top {self.top} frames by wall-clock samples:")
+        for frame, count, share in self.get_hotspots():
+            print(f"{share:6.1%} {count:8d}  {frame}")
+        print(f"\nSaved {stats_path} and {stacks_path}")
+
+    def get_hotspots(self):
+        """
+        Get the frames where the sampled threads spent the most time.
+
+        Returns:
+            list: The frame, number of samples and share of the samples of the ``top`` innermost frames.
+        """
+        frames = Counter()
+        for stack, count in self.samples.items():
+            frames[stack.rsplit(";", 1)[-1]] += count
+        total = sum(frames.values()) or 1
+        return [(frame, count, count / total) for frame, count in frames.most_common(self.top)]
+
+    def _profile_thread(self, frame, event, arg):
+        """Start a profile in every thread started while profiling, cProfile only follows the calling thread."""
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Since Python 3.12 the profile of the main thread already covers every thread
+            return
+        with self._lock:
+            self._thread_profiles.append(profile)
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, "thread"))
+                self.samples[";".join(reversed(stack))] += 1
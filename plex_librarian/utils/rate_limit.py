@@ -0,0 +1,141 @@
+"""This file contains the token bucket rate limiter shared by every thread and process of the host."""
+
+import os
+import re
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Without file locks, e.g. on Windows, the bucket is only shared by the threads of the process
+    fcntl = None
+
+# Next to the response cache, so the state files belong to the user running the tool
+DEFAULT_DIRECTORY = "config/rate-limits"
+# The tokens left and the time they were counted at
+STATE_FORMAT = "dd"
+
+
+class RateLimiter:
+    """
+    Token bucket allowing ``rate`` requests per second on average and bursts of up to ``burst`` requests.
+
+    The bucket is saved in a state file locked with ``flock`` while it's updated, so every thread and
+    every process of the host using the same file, e.g. overlapping cron runs, draws from the same
+    bucket. A request that finds the bucket empty reserves the next token and sleeps until it's due,
+    so the waiting requests are spread evenly instead of retrying at once.
+
+    A state file that can't be opened, is a symlink or belongs to another user is never written,
+    the bucket is only shared by the threads of the process then.
+    """
+
+    def __init__(self, rate, burst=None, path=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.path = path
+        self._lock = threading.Lock()
+        self._fd = None
+        self._state = (self.burst, time.time())
+        if path is not None and fcntl is not None:
+            self._fd = self._open(path)
+
+    @classmethod
+    def for_host(cls, host, limit, directory=None):
+        """
+        Build the limiter of a host from its entry in ``http.rate_limits``.
+
+        Args:
+            host (str): The host and port, e.g. "api.themoviedb.org".
+            limit (float|dict): The requests per second, or a dict with the "rate" and optional "burst".
+            directory (str): The folder of the state files, shared by every process.
+
+        Returns:
+            RateLimiter: The limiter, None if the host isn't limited.
+        """
+        if isinstance(limit, dict):
+            rate, burst = limit.get("rate"), limit.get("burst")
+        else:
+            rate, burst = limit, None
+        if not rate:
+            return None
+        filename = re.sub(r"[^\w.-]", "_", host) + ".bucket"
+        return cls(rate, burst, os.path.join(directory or DEFAULT_DIRECTORY, filename))
+
+    @staticmethod
+    def _open(path):
+        """
+        Open the state file of the bucket.
+
+        Returns:
+            int: The file descriptor, None if the file can't be used safely.
+        """
+        fd = None
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, mode=0o700, exist_ok=True)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, "O_NOFOLLOW", 0), 0o600)
+            if os.fstat(fd).st_uid != os.getuid():
+                raise PermissionError(f"{path} belongs to another user")
+            return fd
+        except OSError as e:
+            if fd is not None:
+                os.close(fd)
+            print(f"Couldn't open the rate limit state {path}, limiting this process only\n{e}")
+            return None
+
+    def acquire(self):
+        """
+        Take a token, waiting until one is available.
+
+        Returns:
+            float: The seconds waited.
+        """
+        wait = self._update(lambda tokens: tokens - 1)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, delay):
+        """Empty the bucket for ``delay`` seconds, e.g. after a 429 response, so no process sends requests meanwhile."""
+        self._update(lambda tokens: min(tokens, -delay * self.rate))
+
+    def _update(self, change):
+        """
+        Refill the bucket, apply a change to its tokens and save it.
+
+        Returns:
+            float: The seconds until the bucket has no debt, 0 if it has tokens left.
+        """
+        with self._lock:
+            if self._fd is None:
+                tokens = self._change(self._state, change)
+                self._state = (tokens, time.time())
+            else:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+                try:
+                    tokens = self._change(self._read(), change)
+                    os.pwrite(self._fd, struct.pack(STATE_FORMAT, tokens, time.time()), 0)
+                finally:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return max(0.0, -tokens / self.rate)
+
+    def _change(self, state, change):
+        tokens, updated = state
+        # A clock going backwards only delays the refill
+        elapsed = max(0.0, time.time() - updated)
+        return change(min(self.burst, tokens + elapsed * self.rate))
+
+    def _read(self):
+        data = os.pread(self._fd, struct.calcsize(STATE_FORMAT), 0)
+        if len(data) != struct.calcsize(STATE_FORMAT):
+            # A new bucket starts full
+            return self.burst, time.time()
+        return struct.unpack(STATE_FORMAT, data)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,280 @@
+"""This file contains the rename engine, which renames the items to the naming convention of Plex."""
+
+import json
+import os
+import re
+import threading
+import time
+from utils.tools import is_valid_name, validate_name
+from utils.workers import run_concurrently
+
+DEFAULT_JOURNAL_PATH = "config/rename-journal.jsonl"
+# The number of renames applied between two syncs of the journal
+BATCH_SIZE = 100
+EDITION_PATTERN = re.compile(r"\{edition-[^}]+\}", re.IGNORECASE)
+
+
+def get_target_name(item):
+    """
+    Get the name an item should have, ``Title (Year) {tmdb-ID}``.
+
+    The ``{edition-...}`` tag of an item is kept, so the editions of a movie stay apart, and single
+    files keep their extension.
+
+    Args:
+        item (MediaItem): The resolved item.
+
+    Returns:
+        str: The name, None if the title, year or TMDB ID of the item is unknown.
+    """
+    if item.title is None or item.year is None or item.tmdb_id is None:
+        return None
+    name = f"{item.title} ({item.year}) {{tmdb-{item.tmdb_id}}}"
+    edition = EDITION_PATTERN.search(item.name)
+    if edition:
+        name = f"{name} {edition.group(0)}"
+    name = validate_name(name)
+    if name is None or not is_valid_name(name):
+        return None
+    return name if item.is_dir else name + os.path.splitext(item.name)[1]
+
+
+def plan_renames(items):
+    """
+    Plan the renames of the items in one pass.
+
+    Renames to the same name and renames to a name already taken in the folder, both compared
+    case-insensitively as on SMB shares, are skipped. Renames changing only the case of the name go through
+    a temporary name, so they work on case-insensitive filesystems too.
+
+    Args:
+        items (list): The resolved items.
+
+    Returns:
+        tuple: The renames, each a dict with its id, source, target and whether only the case changes,
+            and the path of every item that can't be renamed with the reason.
+    """
+    renames = []
+    skipped = []
+    targets = {}
+    for item in items:
+        name = get_target_name(item)
+        if name is None:
+            skipped.append((item.path, "Unknown title, year or TMDB ID"))
+            continue
+        if name == item.name:
+            continue
+        parent = os.path.dirname(item.path)
+        rename = {"source": item.path, "target": os.path.join(parent, name),
+                  "case_only": name.casefold() == item.name.casefold()}
+        targets.setdefault((parent, name.casefold()), []).append(rename)
+
+    # The names of each folder, to find the targets taken by a name differing only in case
+    listings = {}
+    for (parent, target), planned in targets.items():
+        if len(planned) > 1:
+            for rename in planned:
+                others = ", ".join(os.path.basename(other.get("source")) for other in planned if other is not rename)
+                skipped.append((rename.get("source"), f"Same name as {others}"))
+            continue
+        rename = planned[0]
+        if parent not in listings:
+            listings[parent] = _get_names(parent)
+        # The source of a case-only rename has the name of its target, on case-insensitive filesystems too
+        taken = [name for name in listings.get(parent).get(target, [])
+                 if name != os.path.basename(rename.get("source"))]
+        if taken:
+            skipped.append((rename.get("source"), f"{taken[0]} already exists"))
+            continue
+        rename["id"] = len(renames)
+        renames.append(rename)
+    return renames, skipped
+
+
+def _get_names(directory):
+    """Get the names of a folder by their case-folded name."""
+    names = {}
+    try:
+        for name in os.listdir(directory):
+            names.setdefault(name.casefold(), []).append(name)
+    except OSError as e:
+        print(e)
+    return names
+
+
+def apply_renames(journal, renames, workers):
+    """
+    Apply the renames in parallel batches, recording each one in the journal.
+
+    A rename that fails is recorded as "failed", so the next run plans the renames afresh instead of
+    resuming it.
+
+    Returns:
+        tuple: The renames applied and the renames that failed.
+    """
+    return _run(journal, renames, workers, "done", lambda rename: _move(rename, rename.get("source"),
+                                                                          rename.get("target")), "failed")
+
+
+def rollback_renames(journal, renames, workers):
+    """
+    Undo the applied renames of a journal, the last ones first.
+
+    The renames interrupted halfway through a case-only rename are undone too, while the renames
+    that weren't applied yet are cancelled, so they aren't resumed later.
+
+    Returns:
+        tuple: The renames undone and the renames that failed.
+    """
+    undo = [rename for rename in reversed(renames)
+            if rename.get("state") == "done"
+            or (rename.get("state") == "pending" and os.path.lexists(_get_temp_path(rename)))]
+    undo_ids = {rename.get("id") for rename in undo}
+    for rename in renames:
+        if rename.get("state") == "pending" and rename.get("id") not in undo_ids:
+            journal.record(rename.get("id"), "cancelled")
+    return _run(journal, undo, workers, "undone", lambda rename: _move(rename, rename.get("target"),
+                                                                       rename.get("source")))
+
+
+def _run(journal, renames, workers, state, move, failed_state=None):
+    applied = []
+    failed = []
+    for start in range(0, len(renames), BATCH_SIZE):
+        for rename, moved in run_concurrently(move, renames[start:start + BATCH_SIZE], workers):
+            if moved:
+                journal.record(rename.get("id"), state)
+                applied.append(rename)
+            else:
+                if failed_state is not None:
+                    journal.record(rename.get("id"), failed_state)
+                failed.append(rename)
+        journal.sync()
+    return applied, failed
+
+
+def _move(rename, source, target):
+    """
+    Move an item, resuming an interrupted move.
+
+    Returns:
+        bool: True if the item is at the target, False otherwise.
+    """
+    temp_path = _get_temp_path(rename)
+    try:
+        # Interrupted between the two steps of a case-only rename
+        if os.path.lexists(temp_path):
+            os.rename(temp_path, target)
+            return True
+        if not os.path.lexists(source) and os.path.lexists(target):
+            # Moved before the run was interrupted
+            return True
+        if rename.get("case_only"):
+            # On case-sensitive filesystems the target can be another item
+            if os.path.lexists(target) and not os.path.samefile(source, target):
+                print(f"Couldn't rename {source}: {target} already exists")
+                return False
+            os.rename(source, temp_path)
+            os.rename(temp_path, target)
+            return True
+        if os.path.lexists(target):
+            print(f"Couldn't rename {source}: {target} already exists")
+            return False
+        os.rename(source, target)
+        return True
+    except OSError as e:
+        print(f"Couldn't rename {source}\n{e}")
+        return False
+
+
+def _get_temp_path(rename):
+    """Get the temporary name of a case-only rename, the same in both directions."""
+    return os.path.join(os.path.dirname(rename.get("source")), f".plex_librarian-rename-{rename.get('id')}")
+
+
+class RenameJournal:
+    """
+    Append-only JSONL journal of the last rename run.
+
+    The plan is written first, one line per rename, and every rename applied, refused or rolled back
+    is appended as a line with its id and new state ("done", "failed", "undone" or "cancelled"). The
+    journal is synced to disk after every batch, so an interrupted run can be resumed or rolled back
+    from it without scanning the library again.
+    """
+
+    def __init__(self, path=DEFAULT_JOURNAL_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    @classmethod
+    def from_config(cls, config):
+        """Open the journal from the ``rename`` entry of the config."""
+        rename_config = config.get("rename") or {}
+        return cls(rename_config.get("journal", DEFAULT_JOURNAL_PATH))
+
+    def start(self, renames):
+        """
+        Start the journal of a new run with its plan, replacing the journal of the last run.
+
+        Args:
+            renames (list): The renames planned by ``plan_renames``.
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            file.write(json.dumps({"started": time.time(), "renames": len(renames)}) + "\n")
+            for rename in renames:
+                file.write(json.dumps(dict(rename, op="plan")) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+        for rename in renames:
+            rename["state"] = "pending"
+
+    def load(self):
+        """
+        Load the renames of the last run.
+
+        Returns:
+            list: The planned renames, each with its state (pending, done, failed, undone or cancelled),
+                empty if there's no journal.
+        """
+        renames = {}
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line of a journal interrupted while writing
+                    continue
+                if entry.get("op") == "plan":
+                    rename = {key: value for key, value in entry.items() if key != "op"}
+                    renames[rename.get("id")] = dict(rename, state="pending")
+                elif entry.get("id") in renames:
+                    renames[entry.get("id")]["state"] = entry.get("state")
+        return list(renames.values())
+
+    def record(self, rename_id, state):
+        """Record the new state of a rename."""
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(json.dumps({"id": rename_id, "state": state}) + "\n")
+
+    def sync(self):
+        """Write the recorded states to disk."""
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -1,13 +1,10 @@
 """This file contains miscellaneous functions used throughout the code"""
 
 import shutil
-import subprocess
 from datetime import datetime
-import Levenshtein
-from pytube import YouTube
 import os
 import re
-import requests
+from utils.names import parse_movie_name, parse_show_name
 
 
 def validate_name(filename):
@@ -49,89 +46,39 @@ def get_string_similarity(str1, str2):
     Returns:
         int: The number of characters required to change for the two strings to match
     """
+    import Levenshtein
+
     str1 = str1.capitalize()
     str2 = str2.capitalize()
     return Levenshtein.distance(str1, str2)
 
 
-def get_media(sections):
-    # GET MEDIA
-    media = {}
-    for item in sections:
-        _type = item.get("type")
-        paths = item.get("path")
-        section_files_and_folders = []
-        for path in paths:
-            folders_files = os.listdir(path)
-            for entry in folders_files:
-                full_path = os.path.join(path, entry)
-                if os.path.isdir(full_path) or (os.path.isfile(full_path) and is_video_file(entry)):
-                    section_files_and_folders.append(full_path)
-        media[_type] = section_files_and_folders
-    return media
-
-
 def get_movie_title(filename):
-    # Regular expression patterns to match different naming conventions
-    patterns = [
-        r'(?P<title>.+?)\s*\((?P<year>\d{4})\)\s*{tmdb-(?P<tmdb_id>\d+)}',
-        r'(?P<title>.+?)\s*\((?P<year>\d{4})\)',
-        r'(?P<title>.+?)\s*\((?P<year>\d{4})\)\s*-\s*(?P<resolution>\d+p)',
-        r'(?P<title>.+?)\.(?P<year>\d{4})\.(?P<resolution>\d+p)',
-        r'(?P<title>.+?)\s*\((?P<year>\d{4})\)\s*-\s*(?P<codec>[a-zA-Z0-9]+)',
-        r'(?P<title>.+?)\.(?P<year>\d{4})\.(?P<codec>[a-zA-Z0-9]+)',
-        r'(?P<title>.+?)\s*\((?P<year>\d{4})\)\s*-\s*(?P<language>[a-zA-Z]+)',
-        r'(?P<title>.+?)\.(?P<year>\d{4})\.(?P<language>[a-zA-Z]+)',
-        r'(?P<title>.+?)\.(?P<year>\d{4})\s*{tmdb-(?P<tmdb_id>\d+)}',
-    ]
+    """
+    Get the title, year and other info from the filename of a movie.
 
-    result = {}
-    for pattern in patterns:
-        match = re.match(pattern, filename)
-        if match:
-            result.update({
-                'title': match.group('title').replace('.', ' '),
-                'year': int(match.group('year')),
-                'resolution': match.group('resolution') if 'resolution' in match.groupdict() else None,
-                'codec': match.group('codec') if 'codec' in match.groupdict() else None,
-                'language': match.group('language') if 'language' in match.groupdict() else None,
-                'tmdb_id': int(match.group('tmdb_id')) if 'tmdb_id' in match.groupdict() else None
-            })
-            break  # Stop after first match
+    Args:
+        filename (str): The name of the movie file or folder.
 
-    # Return collected information, if any
-    return result or None
+    Returns:
+        dict: The parsed info, None if the filename doesn't match any naming convention.
+    """
+    result = parse_movie_name(filename)
+    return result._asdict() if result is not None else None
 
 
 def get_show_title(filename):
-    # Regular expression patterns to match different naming conventions
-    patterns = [
-        r'(?P<title>.+?)\.S(?P<season>\d{2})',
-        r'(?P<title>.+?)\s*\((?P<year>\d{4})\)',
-        r'(?P<title>.+?)\.S(?P<season>\d{2})E(?P<episode>\d{2})',
-        r'(?P<title>.+?)\s*-\s*S(?P<season>\d{2})E(?P<episode>\d{2})',
-        r'(?P<title>.+?)\.S(?P<season>\d{2})E(?P<episode>\d{1,2})',
-        r'(?P<title>.+?)\.(?P<year>\d{4})\.(?P<month>\d{2})\.(?P<day>\d{2})',
-        r'(?P<title>.+?)\.Season(?P<season>\d+)',
-        r'(?P<title>.+?)\.S(?P<season>\d{2})',
-        r'(?P<title>.+?)\s*Complete',
-    ]
+    """
+    Get the title, season and other info from the filename of a TV show.
 
-    for pattern in patterns:
-        match = re.match(pattern, filename)
-        if match:
-            return {
-                'title': match.group('title').replace('.', ' '),
-                'season': int(match.group('season')) if 'season' in match.groupdict() else None,
-                'episode': int(match.group('episode')) if 'episode' in match.groupdict() else None,
-                'year': int(match.group('year')) if 'year' in match.groupdict() else None,
-                'month': int(match.group('month')) if 'month' in match.groupdict() else None,
-                'day': int(match.group('day')) if 'day' in match.groupdict() else None,
-                'complete': True if 'Complete' in match.group() else False
-            }
-
-    # If no pattern matches, return None
-    return None
+    Args:
+        filename (str): The name of the show file or folder.
+
+    Returns:
+        dict: The parsed info, None if the filename doesn't match any naming convention.
+    """
+    result = parse_show_name(filename)
+    return result._asdict() if result is not None else None
 
 
 def is_image_file(filename):
@@ -194,106 +141,109 @@ def is_valid_name(filename):
         return False
 
 
-def has_poster(directory):
-    """
-    Check if there is a valid image in the specified folder.
-    """
-    for filename in os.listdir(directory):
-        if filename.lower().startswith("poster") and is_image_file(filename):
-            image_path = os.path.join(directory, filename)
-            if os.path.getsize(image_path) != 0:
-                return True
-    return False
-
-
-def has_backdrop(directory):
-    """
-    Check if there is a valid image in the specified folder.
+def download_image(url, destination, validators=None):
     """
-    for filename in os.listdir(directory):
-        if filename.lower().startswith("backdrop") and is_image_file(filename):
-            image_path = os.path.join(directory, filename)
-            if os.path.getsize(image_path) != 0:
-                return True
-    return False
-
+    Download an image and save it to the specified destination.
 
-def has_trailer(filepath):
-    """
-    Check if a file contains a folder named "Trailers" and inside it there is a video called "Official Trailer".
+    The image is written to a hidden ".part" file next to the destination and only renamed to it
+    once its size matches the size announced by the server, so an interrupted download never leaves
+    a truncated image behind. The ".part" file is kept and resumed with a Range request on the next
+    attempt. If the destination exists and was downloaded from the same URL, the image is only
+    downloaded again if it changed on the server.
 
-    Parameters:
-        filepath (str): The path to the file to check.
+    Args:
+        url (str): The URL of the image.
+        destination (str): The path where the image will be saved.
+        validators (dict): The url, etag, last_modified and complete flag of the last download of the
+            destination, updated in place so they can be persisted.
 
     Returns:
-        bool: True if the conditions are met, False otherwise.
+        str: "downloaded" or "unchanged", None if the download failed.
     """
-    trailers_folder = os.path.join(filepath, "Trailers")
-    if os.path.exists(trailers_folder) and os.path.isdir(trailers_folder):
-        media_trailers = os.listdir(trailers_folder)
-        for media in media_trailers:
-            fullpath = os.path.join(trailers_folder, media)
-            if os.path.isfile(fullpath) and is_video_file(media):
-                return True
-    return False
+    from utils import metrics
+
+    with metrics.timer("download_duration_seconds", kind="image"):
+        status = _download_image(url, destination, validators)
+    metrics.increment("downloads_total", kind="image", result=status or "failed")
+    return status
+
+
+def _download_image(url, destination, validators=None):
+    from utils import metrics, transport
+
+    if validators is None:
+        validators = {}
+    temp_path = os.path.join(os.path.dirname(destination), f".{os.path.basename(destination)}.part")
+    validator = validators.get("etag") or validators.get("last_modified")
+    headers = {}
+    offset = 0
+    if validators.get("url") == url and validator:
+        if validators.get("complete") and os.path.exists(destination):
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators.get("etag")
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators.get("last_modified")
+        elif os.path.exists(temp_path):
+            offset = os.path.getsize(temp_path)
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = validator
 
-
-def download_image(url, destination):
     try:
-        response = requests.get(url, stream=True)
-        if response.status_code == 200:
-            with open(destination, 'wb') as file:
-                response.raw.decode_content = True
-                shutil.copyfileobj(response.raw, file)
+        with transport.get(url, headers=headers, stream=True) as response:
+            if response.status_code == 304:
+                return "unchanged"
+            if response.status_code == 206:
+                start, total = _get_content_range(response.headers.get("Content-Range"))
+                if start != offset:
+                    offset = None
+                mode = "ab"
+            elif response.status_code == 200:
+                offset = 0
+                total = None
+                mode = "wb"
+            elif response.status_code == 416:
+                offset = None
+            else:
+                return None
+            if offset is None:
+                # The partial file doesn't line up with the image, start over
+                os.remove(temp_path)
+                return _download_image(url, destination, validators)
+
+            if total is None and response.headers.get("Content-Encoding", "identity") == "identity":
+                content_length = response.headers.get("Content-Length")
+                total = offset + int(content_length) if content_length else None
+            validators.update(url=url, etag=response.headers.get("ETag"),
+                              last_modified=response.headers.get("Last-Modified"), complete=False)
+            with open(temp_path, mode) as file:
+                for chunk in response.iter_content(chunk_size=65536):
+                    file.write(chunk)
+                    metrics.increment("download_bytes_total", len(chunk), kind="image")
+
+        size = os.path.getsize(temp_path)
+        if total is not None and size != total:
+            print(f"Incomplete download of {url}: {size} of {total} bytes")
+            return None
+        os.replace(temp_path, destination)
+        validators["complete"] = True
+        return "downloaded"
     except Exception as e:
         print("Error occurred:", str(e))
+    return None
 
 
-def download_youtube_video(url, destination):
+def _get_content_range(content_range):
     """
-    Download a video from YouTube and save it to the specified destination.
+    Parse a ``Content-Range`` header, e.g. "bytes 100-199/200".
 
-    Parameters:
-        url (str): The URL of the YouTube video.
-        destination (str): The path where the video will be saved.
+    Returns:
+        tuple: The first byte and the total size, None if unknown.
     """
-    try:
-        yt = YouTube(url)
-        video = yt.streams.filter(resolution='1080p').order_by('resolution').desc().first()
-        audio = yt.streams.get_audio_only()
-
-        # Extracting the file extension from the original filename
-        original_filename = video.default_filename
-        file_extension = os.path.splitext(original_filename)[1]
-
-        # Setting the new filename to "Official Trailer" with the original file extension
-        video_filename = "Official Trailer" + file_extension
-        audio_filename = "Official Trailer.mp4"
-
-        # Downloading and renaming the video file
-        video.download(output_path=destination, filename=video_filename)
-        audio.download(output_path=destination, filename=audio_filename)
-
-        video_filepath = os.path.join(destination, video_filename)
-        audio_filepath = os.path.join(destination, audio_filename)
-        destination_filepath = os.path.join(destination, "Official Trailer" + file_extension)
-        combine_audio_video(audio_file=audio_filepath, video_file=video_filepath, output_file=destination_filepath)
-
-        print(f"Video downloaded successfully! {destination}")
-    except Exception as e:
-        print(f"Error: {e}")
-
-
-def delete_images(directory):
-    for filename in os.listdir(directory):
-        if is_image_file(filename):
-            # Form the absolute path to the file
-            filepath = os.path.join(directory, filename)
-            # Attempt to remove the file
-            try:
-                os.remove(filepath)
-            except Exception as e:
-                print(e)
+    match = re.match(r"bytes (\d+)-\d+/(\d+|\*)", content_range or "")
+    if match is None:
+        return None, None
+    total = match.group(2)
+    return int(match.group(1)), int(total) if total != "*" else None
 
 
 def delete_trailer(directory):
@@ -306,18 +256,42 @@ def delete_trailer(directory):
             return
 
 
-def combine_audio_video(video_file, audio_file, output_file):
-    # Run ffmpeg command to combine audio and video
+def combine_audio_video(video_file, audio_file, output_file, output_format=None):
+    """
+    Combine a video and an audio file with ffmpeg.
+
+    Args:
+        video_file (str): The path of the video.
+        audio_file (str): The path of the audio.
+        output_file (str): The path of the combined file, overwritten if it exists.
+        output_format (str): The container format, e.g. "mp4", guessed from the output extension if None.
+
+    Returns:
+        bool: True if ffmpeg succeeded, False otherwise.
+    """
+    import subprocess
+
+    # Run ffmpeg command to combine audio and video, only printing its errors
     ffmpeg_command = [
         'ffmpeg',
+        '-y',
+        '-loglevel', 'error',
         '-i', video_file,
         '-i', audio_file,
+        '-map', '0:v',
+        '-map', '1:a',
         '-c:v', 'copy',
         '-c:a', 'aac',
-        '-strict', 'experimental',
-        output_file
     ]
-    subprocess.run(ffmpeg_command)
+    if output_format:
+        ffmpeg_command += ['-f', output_format]
+    ffmpeg_command.append(output_file)
+    result = subprocess.run(ffmpeg_command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        print(f"ffmpeg failed: {result.stderr.decode(errors='replace').strip()}")
+        return False
+    return True
 
 
 def is_table_empty(table):
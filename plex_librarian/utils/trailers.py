@@ -0,0 +1,277 @@
+"""This file contains the pipeline used to download and mux trailers."""
+
+import errno
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from utils import metrics
+from utils.tools import combine_audio_video
+
+DEFAULT_DOWNLOAD_WORKERS = 4
+DEFAULT_MUX_WORKERS = 2
+TRAILER_NAME = "Official Trailer"
+CONTAINER_FORMATS = {".mp4": "mp4", ".webm": "webm"}
+
+
+class StageStats:
+    """Throughput counters of one stage of the pipeline, safe to update from any thread."""
+
+    def __init__(self, name, unit, key):
+        self.name = name
+        self.unit = unit
+        # The label of the stage in the run metrics
+        self.key = key
+        self.count = 0
+        self.failed = 0
+        self.bytes = 0
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def record(self, started, size=0, ok=True):
+        """
+        Record a finished unit of work.
+
+        Args:
+            started (float): The ``time.monotonic`` when the work started.
+            size (int): The bytes processed.
+            ok (bool): False if the work failed.
+        """
+        finished = time.monotonic()
+        metrics.observe("trailer_stage_duration_seconds", finished - started, stage=self.key)
+        metrics.increment("trailer_stage_total", stage=self.key, result="ok" if ok else "failed")
+        if size:
+            metrics.increment("download_bytes_total", size, kind="trailer")
+        with self._lock:
+            if ok:
+                self.count += 1
+                self.bytes += size
+            else:
+                self.failed += 1
+            self.started = started if self.started is None else min(self.started, started)
+            self.finished = finished if self.finished is None else max(self.finished, finished)
+
+    def summary(self):
+        elapsed = (self.finished - self.started) if self.started is not None else 0
+        line = f"{self.name}: {self.count} {self.unit} in {elapsed:.1f} s"
+        if elapsed > 0:
+            line += f" ({self.count / elapsed:.2f} {self.unit}/s"
+            if self.bytes:
+                line += f", {self.bytes / elapsed / 1e6:.2f} MB/s"
+            line += ")"
+        if self.failed:
+            line += f", {self.failed} failed"
+        return line
+
+
+class TrailerPipeline:
+    """
+    Downloads trailers in stages, each with its own workers.
+
+    The video and audio streams of a trailer are downloaded at the same time by a thread pool
+    and muxed with ffmpeg, at most ``mux_workers`` trailers at once. In "pipe" mode, the default
+    where FIFOs exist, the streams are fed to ffmpeg while they download, the video through its
+    stdin and the audio through a FIFO, so only the final trailer touches the disk. The two feeders
+    of every ffmpeg process get their own pool, as each blocks until ffmpeg reads the other. As the
+    streams download while their trailer is muxed, at most ``mux_workers`` trailers download at once
+    in this mode and ``download_workers`` only bounds the progressive downloads. In "file" mode the
+    streams are downloaded to hidden files by the ``download_workers`` and muxed once complete.
+
+    When YouTube has a progressive stream at the target resolution it is downloaded as is,
+    without muxing. The trailer is always written to a hidden name first and renamed once
+    complete. ``download`` blocks until its trailer is done and can be called from many threads at once.
+    """
+
+    def __init__(self, download_workers=DEFAULT_DOWNLOAD_WORKERS, mux_workers=DEFAULT_MUX_WORKERS, resolution="1080p",
+                 mode="pipe"):
+        self.resolution = resolution
+        self.mode = mode if mode == "file" or hasattr(os, "mkfifo") else "file"
+        self.stats = [StageStats("Stream downloads", "streams", "download"),
+                      StageStats("Muxing", "trailers", "mux")]
+        self._network = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="trailer-download")
+        self._mux_slots = threading.BoundedSemaphore(mux_workers)
+        # Both feeders of every running mux, whatever the number of download workers
+        self._feeders = ThreadPoolExecutor(max_workers=2 * mux_workers, thread_name_prefix="trailer-feed")
+
+    @classmethod
+    def from_config(cls, config):
+        """Create the pipeline from the ``trailers`` entry of the config."""
+        trailers_config = config.get("trailers") or {}
+        return cls(
+            download_workers=trailers_config.get("download_workers", DEFAULT_DOWNLOAD_WORKERS),
+            mux_workers=trailers_config.get("mux_workers", DEFAULT_MUX_WORKERS),
+            resolution=trailers_config.get("resolution", "1080p"),
+            mode=trailers_config.get("mode", "pipe")
+        )
+
+    def download(self, url, destination):
+        """
+        Download a trailer from YouTube into the given folder as "Official Trailer".
+
+        Args:
+            url (str): The URL of the YouTube video.
+            destination (str): The folder where the trailer will be saved.
+
+        Returns:
+            bool: True if the trailer was downloaded, False otherwise.
+        """
+        from pytube import YouTube
+
+        temp_path = None
+        try:
+            yt = YouTube(url)
+            video = yt.streams.filter(progressive=True, resolution=self.resolution).first()
+            audio = None
+            if video is None:
+                video = yt.streams.filter(resolution=self.resolution).order_by('resolution').desc().first()
+                audio = yt.streams.get_audio_only()
+            file_extension = os.path.splitext(video.default_filename)[1]
+            output_path = os.path.join(destination, TRAILER_NAME + file_extension)
+            # Plex ignores hidden files, so the trailer only shows up once it's complete
+            temp_path = os.path.join(destination, f".{TRAILER_NAME}{file_extension}.part")
+            os.makedirs(destination, exist_ok=True)
+
+            if audio is None:
+                self._network.submit(self._download_stream, video, temp_path).result()
+                ok = True
+            elif self.mode == "pipe":
+                ok = self._mux_streams(video, audio, temp_path, CONTAINER_FORMATS.get(file_extension))
+            else:
+                ok = self._mux_files(video, audio, temp_path, CONTAINER_FORMATS.get(file_extension))
+            if ok:
+                os.replace(temp_path, output_path)
+            return ok
+        except Exception as e:
+            print(f"Error: {e}")
+            return False
+        finally:
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _mux_files(self, video, audio, output_path, output_format):
+        """Download both streams to hidden files, then mux them once a mux slot is free."""
+        destination = os.path.dirname(output_path)
+        video_path = os.path.join(destination, f".{TRAILER_NAME}.video.part")
+        audio_path = os.path.join(destination, f".{TRAILER_NAME}.audio.part")
+        futures = []
+        try:
+            futures = [self._network.submit(self._download_stream, video, video_path),
+                       self._network.submit(self._download_stream, audio, audio_path)]
+            for future in futures:
+                future.result()
+
+            # ffmpeg runs in its own process, so a thread waiting on it is enough
+            with self._mux_slots:
+                started = time.monotonic()
+                ok = False
+                try:
+                    ok = combine_audio_video(video_path, audio_path, output_path, output_format)
+                finally:
+                    self.stats[1].record(started, ok=ok)
+            return ok
+        finally:
+            wait(futures)
+            for path in (video_path, audio_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _mux_streams(self, video, audio, output_path, output_format):
+        """Mux both streams while they download, the video through the stdin of ffmpeg and the audio through a FIFO."""
+        import subprocess
+
+        with self._mux_slots:
+            started = time.monotonic()
+            ok = False
+            fifo_dir = tempfile.mkdtemp(prefix="plex-librarian-")
+            fifo_path = os.path.join(fifo_dir, "audio")
+            try:
+                os.mkfifo(fifo_path)
+                ffmpeg_command = [
+                    'ffmpeg',
+                    '-y',
+                    '-loglevel', 'error',
+                    '-i', 'pipe:0',
+                    '-i', fifo_path,
+                    '-map', '0:v',
+                    '-map', '1:a',
+                    '-c:v', 'copy',
+                    '-c:a', 'aac',
+                ]
+                if output_format:
+                    ffmpeg_command += ['-f', output_format]
+                ffmpeg_command.append(output_path)
+                process = subprocess.Popen(ffmpeg_command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+                futures = [self._feeders.submit(self._feed_stream, video, process.stdin),
+                           self._feeders.submit(self._feed_fifo, audio, fifo_path, process)]
+                try:
+                    for future in futures:
+                        future.result()
+                except Exception:
+                    # Unblocks the other feeder with a broken pipe
+                    process.kill()
+                    raise
+                finally:
+                    wait(futures)
+                    # The feeders own stdin, so ``communicate`` can't be used
+                    errors = process.stderr.read()
+                    process.stderr.close()
+                    process.wait()
+                ok = process.returncode == 0
+                if not ok:
+                    print(f"ffmpeg failed: {errors.decode(errors='replace').strip()}")
+                return ok
+            finally:
+                self.stats[1].record(started, ok=ok)
+                shutil.rmtree(fifo_dir, ignore_errors=True)
+
+    def _download_stream(self, stream, path):
+        started = time.monotonic()
+        try:
+            stream.download(output_path=os.path.dirname(path), filename=os.path.basename(path))
+        except Exception:
+            self.stats[0].record(started, ok=False)
+            raise
+        self.stats[0].record(started, size=os.path.getsize(path))
+
+    def _feed_stream(self, stream, pipe):
+        """Download a stream chunk by chunk into a pipe, closing the pipe at the end."""
+        from pytube import request
+
+        started = time.monotonic()
+        size = 0
+        try:
+            with pipe:
+                for chunk in request.stream(stream.url):
+                    pipe.write(chunk)
+                    size += len(chunk)
+        except Exception:
+            self.stats[0].record(started, ok=False)
+            raise
+        self.stats[0].record(started, size=size)
+
+    def _feed_fifo(self, stream, fifo_path, process):
+        """Feed a stream into the FIFO once ffmpeg opens it, giving up if ffmpeg exits first."""
+        while True:
+            try:
+                # A blocking open would hang forever if ffmpeg never reads the FIFO
+                fd = os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+                if process.poll() is not None:
+                    raise RuntimeError("ffmpeg exited before reading the audio stream")
+                time.sleep(0.05)
+        os.set_blocking(fd, True)
+        self._feed_stream(stream, os.fdopen(fd, "wb"))
+
+    def close(self):
+        """Wait for the running work, stop the workers and print the throughput of each stage."""
+        self._network.shutdown()
+        self._feeders.shutdown()
+        for stage in self.stats:
+            if stage.started is not None:
+                print(stage.summary())
@@ -0,0 +1,184 @@
+"""This file contains the shared HTTP transport used by every service."""
+
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from utils import metrics
+from utils.rate_limit import RateLimiter
+
+DEFAULT_SETTINGS = {
+    "pool_size": 16,
+    "connect_timeout": 5,
+    "timeout": 30,
+    "retries": 5,
+    "backoff": 0.5,
+    "max_backoff": 30,
+    "max_retry_after": 120,
+    # The folder of the rate limit state files, the temporary folder of the system if None
+    "rate_limit_dir": None,
+}
+# The requests per second allowed per host, TMDB allows about 40-50 per IP
+DEFAULT_RATE_LIMITS = {
+    "api.themoviedb.org": {"rate": 40, "burst": 20},
+}
+RETRY_STATUSES = {500, 502, 503, 504}
+
+_settings = dict(DEFAULT_SETTINGS)
+_sessions = {}
+_limiters = {}
+_lock = threading.Lock()
+
+
+def configure(config):
+    """
+    Configure the transport from the ``http`` entry of the config.
+
+    Args:
+        config (dict): The loaded config.yml.
+    """
+    with _lock:
+        _settings.update((config or {}).get("http") or {})
+        # Sessions built with the old pool size are dropped and rebuilt on first use
+        _sessions.clear()
+        for limiter in _limiters.values():
+            if limiter is not None:
+                limiter.close()
+        _limiters.clear()
+
+
+def get_session(url):
+    """
+    Get the pooled session of the host of a URL.
+
+    Args:
+        url (str): Any URL of the host.
+
+    Returns:
+        requests.Session: The session, shared by every thread talking to the host.
+    """
+    parts = urlsplit(url)
+    host = f"{parts.scheme}://{parts.netloc}"
+    with _lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=_settings.get("pool_size"))
+            session.mount(f"{host}/", adapter)
+            _sessions[host] = session
+    return session
+
+
+def get_limiter(host):
+    """
+    Get the rate limiter of a host, from ``http.rate_limits`` and the defaults.
+
+    Args:
+        host (str): The host and port, e.g. "api.themoviedb.org" or "192.168.1.10:32400".
+
+    Returns:
+        RateLimiter: The limiter shared by every thread talking to the host, None if it isn't limited.
+    """
+    with _lock:
+        if host not in _limiters:
+            limits = dict(DEFAULT_RATE_LIMITS, **(_settings.get("rate_limits") or {}))
+            _limiters[host] = RateLimiter.for_host(host, limits.get(host), _settings.get("rate_limit_dir"))
+        return _limiters[host]
+
+
+def get(url, **kwargs):
+    """Send a GET request, see ``request``."""
+    return request("GET", url, **kwargs)
+
+
+def request(method, url, **kwargs):
+    """
+    Send a request through the pooled session of its host.
+
+    Connection errors, timeouts and 5xx responses are retried with exponential backoff and jitter,
+    429 responses are retried after the delay of their ``Retry-After`` header. Every attempt waits
+    for the rate limiter of the host, if it has one.
+
+    Args:
+        method (str): The HTTP method.
+        url (str): The URL of the request.
+        **kwargs: Any argument accepted by ``requests.Session.request``.
+
+    Returns:
+        requests.Response: The response of the last attempt.
+
+    Raises:
+        requests.RequestException: If the last attempt failed to connect.
+    """
+    kwargs.setdefault("timeout", (_settings.get("connect_timeout"), _settings.get("timeout")))
+    session = get_session(url)
+    host = urlsplit(url).netloc
+    limiter = get_limiter(host)
+    retries = _settings.get("retries")
+    for attempt in range(retries + 1):
+        last_attempt = attempt == retries
+        if limiter is not None:
+            waited = limiter.acquire()
+            if waited:
+                metrics.increment("rate_limit_wait_seconds_total", waited, host=host)
+        started = time.perf_counter()
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            reason = "timeout" if isinstance(e, requests.Timeout) else "connection"
+            metrics.increment("http_requests_total", host=host, status=reason)
+            if last_attempt:
+                raise
+            metrics.increment("http_retries_total", host=host, reason=reason)
+            time.sleep(_get_backoff(attempt))
+            continue
+        # Streamed responses are timed until their headers arrive
+        metrics.observe("http_request_duration_seconds", time.perf_counter() - started, host=host)
+        metrics.increment("http_requests_total", host=host, status=response.status_code)
+
+        if last_attempt:
+            return response
+        if response.status_code == 429:
+            delay = _get_retry_after(response)
+            if delay is None:
+                delay = _get_backoff(attempt)
+            if limiter is not None:
+                # The other threads and processes back off too
+                limiter.pause(delay)
+        elif response.status_code in RETRY_STATUSES:
+            delay = _get_backoff(attempt)
+        else:
+            return response
+        metrics.increment("http_retries_total", host=host, reason=response.status_code)
+        response.close()
+        time.sleep(delay)
+
+
+def _get_backoff(attempt):
+    """Get the exponential backoff delay of an attempt, with full jitter."""
+    delay = min(_settings.get("max_backoff"), _settings.get("backoff") * 2 ** attempt)
+    return random.uniform(0, delay)
+
+
+def _get_retry_after(response):
+    """
+    Get the delay requested by the ``Retry-After`` header of a response.
+
+    Returns:
+        float: The delay in seconds, None if the header is missing or invalid.
+    """
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(delay, 0), _settings.get("max_retry_after"))
@@ -0,0 +1,37 @@
+"""This file contains the execution engine used to process media items concurrently."""
+
+from itertools import islice
+
+DEFAULT_WORKERS = 8
+
+
+def run_concurrently(func, items, workers=DEFAULT_WORKERS):
+    """
+    Run a function over the items with a bounded thread pool.
+
+    At most ``workers`` items are processed at once and at most ``2 * workers`` are queued,
+    so the number of in-flight requests stays bounded no matter how many items there are.
+    Results are yielded in the main thread as soon as each item finishes, so callers can
+    safely update progress bars and tables.
+
+    Args:
+        func (callable): The function to run for each item.
+        items (iterable): The items to process.
+        workers (int): The maximum number of items processed at once.
+
+    Yields:
+        tuple: The item and the value returned by ``func`` for it.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    workers = max(1, int(workers))
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(func, item): item for item in islice(items, workers * 2)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                for next_item in islice(items, 1):
+                    pending[executor.submit(func, next_item)] = next_item
+                yield item, future.result()